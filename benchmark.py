@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import particle_distribution
+
+## Synthetic EPU / CryoSPARC session
+
+# EPU CustomData keys, in the order EPU writes them (DoseOnCamera first, AppliedDefocus 18th)
+EPU_CUSTOM_DATA_KEYS = [
+    "DoseOnCamera", "Detectors[EF-Falcon].CommercialName", "Detectors[EF-Falcon].DetectorName", "Detectors[EF-Falcon].DetectorType",
+    "Detectors[EF-Falcon].ElectronCounted", "Detectors[EF-Falcon].ExposureTime", "Detectors[EF-Falcon].FrameExposureTime",
+    "Detectors[EF-Falcon].Gain", "Detectors[EF-Falcon].Offset", "Detectors[EF-Falcon].SuperResolutionFactor",
+    "Detectors[EF-Falcon].TotalDose", "PhasePlateUsed", "AppliedDefocusDelta", "AutoFocusGroupId", "AutomationVersion",
+    "ClusterCenter", "DoseFractionationType", "AppliedDefocus", "FocusMethod",
+]
+
+EPU_XML_TEMPLATE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<MicroscopeImage xmlns="http://schemas.datacontract.org/2004/07/Fei.SharedObjects" xmlns:i="http://www.w3.org/2001/XMLSchema-instance">'
+    "<name>{name}</name><uniqueID>{uid}</uniqueID>"
+    '<CustomData xmlns:a="http://schemas.microsoft.com/2003/10/Serialization/Arrays">{custom_data}</CustomData>'
+    "<acquisitionDateTime>{acquired}</acquisitionDateTime>"
+    "<microscopeData><acquisition><acquisitionDateTime>{acquired}</acquisitionDateTime></acquisition>"
+    "<optics><Defocus>{defocus}</Defocus></optics>"
+    "<stage><Position><A>0</A><B>0</B><X>{x}</X><Y>{y}</Y><Z>{z}</Z></Position></stage></microscopeData>"
+    "</MicroscopeImage>"
+)
+
+# Write one EPU-style XML file with the given DoseOnCamera, AppliedDefocus (m) and stage position (m)
+def write_epu_xml(xml_path, name, acquired, dose_on_camera, applied_defocus, x, y, z):
+    values = {"DoseOnCamera": dose_on_camera, "AppliedDefocus": applied_defocus}
+    custom_data = "".join(
+        f'<a:KeyValueOfstringanyType><a:Key>{key}</a:Key><a:Value i:type="b:double" xmlns:b="http://www.w3.org/2001/XMLSchema">{values.get(key, 0)}</a:Value></a:KeyValueOfstringanyType>'
+        for key in EPU_CUSTOM_DATA_KEYS
+    )
+    with open(xml_path, "w") as f:
+        f.write(EPU_XML_TEMPLATE.format(
+            name=name, uid=os.path.basename(xml_path), custom_data=custom_data, acquired=acquired.isoformat(),
+            defocus=applied_defocus, x=x, y=y, z=z,
+        ))
+
+# Fabricate an EPU session, its symlink directory and a CryoSPARC project with one particle job (J1) under root
+# Movies are empty (or sparse, with movie_size bytes), particles are written as a .cs file or as particles.star
+def generate_session(root, num_micrographs=1000, num_gridsquares=10, particles_per_micrograph=50, empty_fraction=0.1,
+                     particle_format="cs", movie_size=0, seed=0):
+    root = os.path.abspath(root)
+    rng = np.random.default_rng(seed)
+    images_root = os.path.join(root, "session", "Images-Disc1")
+    rawdata = os.path.join(root, "rawdata")
+    project = os.path.join(root, "project")
+    job = os.path.join(project, "J1")
+    for directory in [images_root, rawdata, job]:
+        os.makedirs(directory, exist_ok=True)
+
+    # Micrographs are collected grid square by grid square, a few seconds apart
+    gridsquares = rng.integers(0, num_gridsquares, num_micrographs)
+    gridsquares.sort()
+    start = datetime(2024, 1, 1, 9, 0, 0)
+    defocus_values = np.array([-0.8, -1.0, -1.2, -1.4, -1.6, -1.8, -2.0]) * 1e-6
+    micrograph_names = []
+
+    for i, gridsquare in enumerate(gridsquares.tolist()):
+        gridsquare_name = f"GridSquare_{2000000 + gridsquare * 17}"
+        data_dir = os.path.join(images_root, gridsquare_name, "Data")
+        if i == 0 or gridsquare != gridsquares[i - 1]:
+            os.makedirs(data_dir, exist_ok=True)
+            link = os.path.join(rawdata, gridsquare_name)
+            if not os.path.lexists(link):
+                os.symlink(os.path.join(images_root, gridsquare_name), link)
+
+        acquired = start + timedelta(seconds=4 * i)
+        stem = f"FoilHole_{3000000 + i}_Data_{4000000 + i % 7}_{5000000 + i % 3}_{acquired:%Y%m%d_%H%M%S}"
+        movie_path = os.path.join(data_dir, f"{stem}_Fractions.tiff")
+        with open(movie_path, "wb") as f:
+            if movie_size:
+                f.truncate(movie_size)
+        write_epu_xml(
+            os.path.join(data_dir, f"{stem}.xml"), stem, acquired,
+            dose_on_camera=rng.uniform(20, 45), applied_defocus=rng.choice(defocus_values),
+            x=rng.uniform(-1e-3, 1e-3), y=rng.uniform(-1e-3, 1e-3), z=rng.uniform(-1e-6, 1e-6),
+        )
+        micrograph_names.append(f"J2/motioncorrected/{1000000000 + i}_{stem}_Fractions_patch_aligned_doseweighted.mrc")
+
+    # Particles per micrograph, with a fraction of empty micrographs
+    counts = rng.poisson(particles_per_micrograph, num_micrographs)
+    counts[rng.random(num_micrographs) < empty_fraction] = 0
+    particle_micrographs = np.repeat(np.array(micrograph_names, dtype="S"), counts)
+    num_particles = len(particle_micrographs)
+
+    with open(os.path.join(project, "workspaces.json"), "w") as f:
+        json.dump([{"uid": "W1", "file_engine_watch_path_abs": rawdata}], f, indent=4)
+    job_data = {"uid": "J1", "workspace_uids": ["W1"], "output_results": []}
+
+    if particle_format == "cs":
+        particles = np.zeros(num_particles, dtype=[
+            ("uid", "<u8"), ("location/micrograph_uid", "<u8"), ("location/micrograph_path", particle_micrographs.dtype),
+            ("location/center_x_frac", "<f4"), ("location/center_y_frac", "<f4"),
+        ])
+        particles["uid"] = rng.integers(0, 2 ** 63, num_particles, dtype=np.uint64)
+        particles["location/micrograph_uid"] = np.repeat(np.arange(num_micrographs, dtype=np.uint64), counts)
+        particles["location/micrograph_path"] = particle_micrographs
+        particles["location/center_x_frac"] = rng.random(num_particles)
+        particles["location/center_y_frac"] = rng.random(num_particles)
+        with open(os.path.join(job, "J1_passthrough_particles.cs"), "wb") as f:
+            np.save(f, particles)
+        job_data["output_results"].append({"group_name": "particles", "name": "location", "metafiles": ["J1/J1_passthrough_particles.cs"]})
+    else:
+        # Stand-in for cs2star (called as cs2star -f J1 outdir) that copies the pre-written particles.star
+        bin_dir = os.path.join(root, "bin")
+        os.makedirs(bin_dir, exist_ok=True)
+        with open(os.path.join(bin_dir, "cs2star"), "w") as f:
+            f.write(f'#!/bin/sh\ncp "{os.path.join(job, "particles.star")}" "$3/particles.star"\n')
+        os.chmod(os.path.join(bin_dir, "cs2star"), 0o755)
+        with open(os.path.join(job, "particles.star"), "w") as f:
+            f.write("\n# version 30001\n\ndata_optics\n\nloop_\n_rlnOpticsGroupName #1\n_rlnOpticsGroup #2\nopticsGroup1 1\n\n")
+            f.write("\n# version 30001\n\ndata_particles\n\nloop_\n_rlnImageName #1\n_rlnMicrographName #2\n_rlnCoordinateX #3\n_rlnCoordinateY #4\n")
+            for start_row in range(0, num_particles, 100000):
+                rows = particle_micrographs[start_row:start_row + 100000].astype(str).tolist()
+                f.write("".join(
+                    f"{(start_row + i) % 1000000 + 1:06d}@J1/extract/{name.split('/')[-1].replace('.mrc', '_particles.mrc')} {name} 1000.0 1000.0\n"
+                    for i, name in enumerate(rows)
+                ))
+            f.write("\n")
+
+    with open(os.path.join(job, "job.json"), "w") as f:
+        json.dump(job_data, f, indent=4)
+
+    print(f"Generated {num_micrographs} micrographs in {len(np.unique(gridsquares))} grid squares and {num_particles} particles under {root}")
+    return {"micrographs": num_micrographs, "gridsquares": int(len(np.unique(gridsquares))), "particles": int(num_particles), "format": particle_format}
+
+## Benchmark harness
+
+# Peak resident set size so far in MB, of this process and of its finished worker processes
+def peak_rss_mb():
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, kB on Linux
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1e6,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 1e6,
+    }
+
+# Current git commit of the script, so results can be compared across versions
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Stage timings that also record the peak RSS when each stage ends
+class BenchmarkTimings(particle_distribution.StageTimings):
+    def add(self, name, seconds, items=None, fs_calls=0, job=None):
+        super().add(name, seconds, items, fs_calls, job)
+        self.stages[-1]["peak_rss_mb"] = peak_rss_mb()
+        print(f"{name:>40}: {seconds:8.3f} s, {items} items, {fs_calls} fs calls")
+
+# Run particle_distribution.py on job J1 of a generated session, as from the project directory, recording its stage timings
+# The metadata cache and raw data path memo are kept under root/cache, and root/bin (the fake cs2star) is put on PATH
+def run_benchmark(root, workers=1, plots=True, cache=True, rebuild_cache=False):
+    root = os.path.abspath(root)
+    os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+    os.environ["PATH"] = os.path.join(root, "bin") + os.pathsep + os.environ.get("PATH", "")
+    args = argparse.Namespace(
+        rawdatapath=None, no_cache=not cache, rebuild_cache=rebuild_cache, plots=None, no_plots=not plots, watch=False, interval=None,
+    )
+    current_directory = os.getcwd()
+    os.chdir(os.path.join(root, "project"))
+    try:
+        shutil.rmtree(particle_distribution.job_folder_name("J1"), ignore_errors=True)
+        folder_names = particle_distribution.create_output_folders(["J1"])
+        timings = particle_distribution.run_analysis(args, ["J1"], folder_names, workers, BenchmarkTimings())
+    finally:
+        os.chdir(current_directory)
+
+    return {
+        "stages": timings.stages,
+        "total_seconds": time.perf_counter() - timings.start_time,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic EPU / CryoSPARC session and benchmark particle_distribution.py against it")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Generate a synthetic session")
+    run_parser = subparsers.add_parser("run", help="Benchmark particle_distribution.py against a session (generated first if it does not exist)")
+    for subparser in [generate_parser, run_parser]:
+        subparser.add_argument("root", help="Directory of the synthetic session")
+        subparser.add_argument("--micrographs", type=int, default=1000)
+        subparser.add_argument("--gridsquares", type=int, default=10)
+        subparser.add_argument("--particles-per-micrograph", type=float, default=50)
+        subparser.add_argument("--format", choices=["cs", "star"], default="cs", help="Write particles as a .cs file or as particles.star")
+        subparser.add_argument("--movie-size", type=int, default=0, help="Size in bytes of the (sparse) movie files")
+        subparser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--workers", type=int, default=min(32, os.cpu_count() or 1))
+    run_parser.add_argument("--no-plots", action="store_true")
+    run_parser.add_argument("--no-cache", action="store_true", help="Parse every XML file instead of using the metadata cache")
+    run_parser.add_argument("--rebuild-cache", action="store_true", help="Parse every XML file again and rewrite the metadata cache")
+    run_parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    generate_args = dict(
+        num_micrographs=args.micrographs, num_gridsquares=args.gridsquares, particles_per_micrograph=args.particles_per_micrograph,
+        particle_format=args.format, movie_size=args.movie_size, seed=args.seed,
+    )
+    if args.command == "generate":
+        generate_session(args.root, **generate_args)
+        return
+
+    if not os.path.exists(os.path.join(args.root, "project")):
+        dataset = generate_session(args.root, **generate_args)
+    else:
+        dataset = {"root": os.path.abspath(args.root)}
+    results = run_benchmark(
+        args.root, max(1, args.workers), plots=not args.no_plots, cache=not args.no_cache, rebuild_cache=args.rebuild_cache
+    )
+    results.update(
+        dataset=dataset,
+        workers=args.workers,
+        git_commit=git_commit(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        date=datetime.now().isoformat(timespec="seconds"),
+    )
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Total {results['total_seconds']:.2f} s, peak RSS {results['peak_rss_mb']['self']:.0f} MB, results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
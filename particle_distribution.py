@@ -1,262 +1,984 @@
 import os
 import sys
 import json
+import argparse
+from dataclasses import dataclass, replace
 import subprocess
 import numpy as np
-import fnmatch
 import glob
 import re
+import shlex
+import time
+import sqlite3
+import struct
+import zipfile
+import cProfile
+import pstats
 import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-
-def main():
-
-    ## Check inputs and generate required folders / paths
-
-    if len(sys.argv) < 2:
-        print("Usage: python particle_distribution.py {job} {rawdatapath (optional)}")
-        return
-
-    job = sys.argv[1]
-    rawdatapath = sys.argv[2] if len(sys.argv) > 2 else None
-
-    # Extract the number after the last 'J' in the job input
-    try:
-        job_number = job.split('J')[-1]
-        folder_name = f"particle_stats_J{job_number}"
-    except IndexError:
-        print("Invalid job format. Ensure the job contains 'J' followed by a number.")
-        return
-
-    # Create the main folder and the inputs subfolder
-    os.makedirs(f"{folder_name}/inputs", exist_ok=True)
-    os.makedirs(f"{folder_name}/particles_vs_transmission_gridsquares", exist_ok=True)
-    os.makedirs(f"{folder_name}/output_CSVs", exist_ok=True)
-
-    # Run the cs2star command
-    subprocess.run(["cs2star", "-f", job, f"{folder_name}/inputs"])
-
-    # Determine rawdatapath
-    if rawdatapath:
-        pass
-    else:
-        # Try to find rawdatapath automatically
-        try:
-            # Read the job.json file
-            job_json_path = os.path.join(job, "job.json")
-            with open(job_json_path, "r") as job_file:
-                job_data = json.load(job_file)
-
-            # Extract the workspace UID
-            workspace_uid = None
-            if "workspace_uids" in job_data:
-                workspace_uids = job_data["workspace_uids"]
-                if isinstance(workspace_uids, list) and len(workspace_uids) > 0:
-                    workspace_uid = workspace_uids[0]
-
-            # Read the workspaces.json file
-            workspaces_json_path = os.path.join(job, "../workspaces.json")
-            with open(workspaces_json_path, "r") as workspaces_file:
-                workspaces_data = workspaces_file.readlines()
-
-            # Look for all "file_engine_watch_path_abs" entries
-            rawdatapaths = []
-            for line in workspaces_data:
-                if '"file_engine_watch_path_abs":' in line:
-                    rawdatapath_candidate = line.split(":")[1].strip().strip('"').strip('",')
-                    rawdatapaths.append(rawdatapath_candidate)
-
-            # If there is only one "file_engine_watch_path_abs", use it
-            if len(rawdatapaths) == 1:
-                rawdatapath = rawdatapaths[0]
-                print(f"Automatically determined rawdatapath: {rawdatapath}")
+from matplotlib.collections import PolyCollection
+
+## STAR files
+
+STAR_READ_SIZE = 16 * 1024 * 1024
+STAR_BATCH_ROWS = 1000000
+
+# Split a STAR data row into fields, honouring quoted values that contain spaces
+def split_star_row(line):
+    if '"' in line or "'" in line:
+        return shlex.split(line)
+    return line.split()
+
+# Stream columns of a STAR loop_ as batches of NumPy string arrays, reading the file in large buffered chunks
+# The loop used is the first one (in data block data_{block}, if given) whose header has any of the requested columns
+# Columns are resolved by their position in the loop_ header, and each batch is a dict of the requested columns found in it
+# Memory stays bounded by batch_size rows of the requested columns, whatever the size of the file
+def iter_star_columns(star_path, columns, block=None, batch_size=STAR_BATCH_ROWS):
+    block_name = None
+    header = []
+    in_header = False
+    positions = None
+    buffers = None
+    remainder = b""
+
+    with open(star_path, "rb") as f:
+        while True:
+            chunk = f.read(STAR_READ_SIZE)
+            if not chunk:
+                lines = [remainder.decode()] if remainder else []
             else:
-                # If there are multiple paths, match the workspace UID
-                for i, line in enumerate(workspaces_data):
-                    if f'"uid": "{workspace_uid}"' in line:
-                        # Look for the file_engine_watch_path_abs after the matching UID
-                        for next_line in workspaces_data[i:]:
-                            if '"uid":' in next_line:  # Stop if another UID is encountered
-                                break
-                            if '"file_engine_watch_path_abs":' in next_line:
-                                rawdatapath = next_line.split(":")[1].strip().strip('"').strip('",')
-                                print(f"Automatically determined raw data path: {rawdatapath}")
-                                break
+                chunk = remainder + chunk
+                split_at = chunk.rfind(b"\n") + 1
+                lines = chunk[:split_at].decode().split("\n")
+                remainder = chunk[split_at:]
+
+            finished = not chunk
+            for line in lines:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+
+                # Rows of the loop being read, until the next data block, loop or key
+                if positions is not None:
+                    if line.startswith(("data_", "loop_", "_")):
+                        finished = True
                         break
+                    fields = split_star_row(line)
+                    for column, position in positions.items():
+                        buffers[column].append(fields[position])
+                    if len(buffers[column]) >= batch_size:
+                        yield {column: np.array(values) for column, values in buffers.items()}
+                        buffers = {column: [] for column in positions}
+                    continue
+
+                if line.startswith("data_"):
+                    block_name = line[len("data_"):]
+                    in_header = False
+                elif line == "loop_":
+                    header = []
+                    in_header = True
+                elif in_header and line.startswith("_"):
+                    header.append(line.split()[0])
+                elif in_header:
+                    # First row of a loop, check whether it is the one we want
+                    in_header = False
+                    if block is not None and block_name != block:
+                        continue
+                    positions = {column: header.index(column) for column in columns if column in header}
+                    if not positions:
+                        positions = None
+                        continue
+                    buffers = {column: [] for column in positions}
+                    fields = split_star_row(line)
+                    for column, position in positions.items():
+                        buffers[column].append(fields[position])
+            if finished:
+                break
+
+    if buffers and any(buffers.values()):
+        yield {column: np.array(values) for column, values in buffers.items()}
+
+## Particle counting
+
+# Normalize a micrograph or particle path to its FoilHole stem (i.e. FoilHole_XXX_Data_XXX_XXX_YYYYMMDD_HHMMSS)
+def foilhole_stem(name):
+    start = name.find("FoilHole")
+    if start == -1:
+        return None
+    end = name.find("Fractions", start)
+    if end == -1:
+        return None
+    return name[start:end].rstrip("_")
+
+# Count particles per FoilHole stem, adding to existing counts if given
+# Particle micrograph names arrive in batches, and each distinct name is only looked up once per batch
+def count_particles_per_stem(particle_micrograph_batches, counts=None):
+    counts = {} if counts is None else counts
+    for batch in particle_micrograph_batches:
+        unique_names, batch_counts = np.unique(np.asarray(batch), return_counts=True)
+        for name, count in zip(unique_names.tolist(), batch_counts.tolist()):
+            stem = foilhole_stem(name.decode() if isinstance(name, bytes) else name)
+            if stem is not None:
+                counts[stem] = counts.get(stem, 0) + count
+    return counts
+
+# Count particles per micrograph by hashing micrograph FoilHole stems
+def count_particles_per_micrograph(particle_micrograph_batches, micrograph_names):
+    counts = count_particles_per_stem(particle_micrograph_batches)
+    return np.array([counts.get(foilhole_stem(name), 0) for name in micrograph_names], dtype=np.int64)
+
+## EPU directory index
+
+# Function to extract the timestamp from the micrograph name
+def extract_timestamp(path):
+    match = re.search(r"FoilHole_.*_Data_.*_.*_(\d{8}_\d{6})_Fractions", path)
+    if match:
+        return match.group(1)  # Return the timestamp (YYYYMMDD_HHMMSS)
+    return None
+
+# Acquisition times of micrographs from the timestamps in their names, NaT where there is none
+def acquisition_times(micrograph_names):
+    timestamps = [extract_timestamp(name) for name in micrograph_names]
+    return np.array([
+        f"{t[0:4]}-{t[4:6]}-{t[6:8]}T{t[9:11]}:{t[11:13]}:{t[13:15]}" if t else "NaT" for t in timestamps
+    ], dtype="datetime64[s]")
+
+# Walk {images_root}/*/Data once with os.scandir and index every FoilHole movie and XML file by its FoilHole stem
+# Sessions split across several Images-Disc* directories are indexed together by passing a list of roots
+# Given a previous index, only Data directories modified since they were last scanned are read again,
+# and the movie stems added by this call are listed in epu_index["new_fractions"]
+def index_epu_directory(images_roots, epu_index=None):
+    start_time = time.perf_counter()
+    if isinstance(images_roots, str):
+        images_roots = [images_roots]
+    if epu_index is None:
+        epu_index = {"fractions": {}, "xml": {}, "gridsquares": {}, "data_dirs": {}}
+    epu_index.update(entries=0, new_fractions=[])
+    scan_time = time.time()
+
+    for images_root in images_roots:
+        with os.scandir(images_root) as gridsquare_entries:
+            for gridsquare_entry in gridsquare_entries:
+                epu_index["entries"] += 1
+                if not gridsquare_entry.is_dir():
+                    continue
+                data_dir = os.path.join(gridsquare_entry.path, "Data")
+                try:
+                    data_mtime = counted_stat(data_dir).st_mtime
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+
+                # Skip directories that have not changed since they were last scanned, allowing for coarse mtime resolution
+                last_mtime, last_scan_time = epu_index["data_dirs"].get(data_dir, (None, None))
+                if data_mtime == last_mtime and last_scan_time - data_mtime > 2:
+                    continue
+                epu_index["data_dirs"][data_dir] = (data_mtime, scan_time)
+
+                with os.scandir(data_dir) as data_entries:
+                    for entry in data_entries:
+                        epu_index["entries"] += 1
+                        if not entry.name.startswith("FoilHole"):
+                            continue
+                        stem = foilhole_stem(entry.name)
+                        if entry.name.endswith(".xml"):
+                            # Only the per-exposure XML (FoilHole_..._HHMMSS.xml) carries the metadata we need
+                            xml_stem = os.path.splitext(entry.name)[0]
+                            if stem is None and xml_stem not in epu_index["xml"]:
+                                epu_index["xml"][xml_stem] = entry.path
+                        elif stem is not None and stem not in epu_index["fractions"]:
+                            epu_index["fractions"][stem] = entry.path
+                            epu_index["gridsquares"][stem] = gridsquare_entry.name
+                            epu_index["new_fractions"].append(stem)
+
+    epu_index["seconds"] = time.perf_counter() - start_time
+    return epu_index
+
+## EPU XML metadata
+
+XML_METADATA_KEYS = ("DoseOnCamera", "AppliedDefocus")
+
+# Stream an EPU XML file and stop as soon as DoseOnCamera, AppliedDefocus (by key name) and the stage position have been found
+# Returns DoseOnCamera, AppliedDefocus (µm) and stage X / Y (µm), NaN for anything missing
+def extract_micrograph_metadata(xml_path):
+    values = {}
+    stage_position = {}
+    key = None
+    try:
+        with open(xml_path, "rb") as xml_file:
+            for _, element in ET.iterparse(xml_file, events=("end",)):
+                tag = element.tag.rsplit("}", 1)[-1]
+                if tag == "Key":
+                    key = element.text
+                elif tag == "Value":
+                    if key in XML_METADATA_KEYS:
+                        values[key] = float(element.text)
+                    key = None
+                elif tag == "stage":
+                    # microscopeData/stage/Position/X and Y, in m
+                    for position in element:
+                        if position.tag.rsplit("}", 1)[-1] == "Position":
+                            for coordinate in position:
+                                coordinate_tag = coordinate.tag.rsplit("}", 1)[-1]
+                                if coordinate_tag in ("X", "Y"):
+                                    stage_position[coordinate_tag] = float(coordinate.text)
+                    stage_position.setdefault("X", np.nan)
+                    stage_position.setdefault("Y", np.nan)
+                else:
+                    continue
+                if len(values) == len(XML_METADATA_KEYS) and stage_position:
+                    break
+    except Exception as e:
+        print(f"Error reading XML file {xml_path}: {e}")
+        return np.nan, np.nan, np.nan, np.nan
+
+    raw_dose_on_camera = values.get("DoseOnCamera", np.nan)
+    applied_defocus = values.get("AppliedDefocus", np.nan) * 1e6  # Convert AppliedDefocus to µm
+    stage_x = stage_position.get("X", np.nan) * 1e6  # Convert stage position to µm
+    stage_y = stage_position.get("Y", np.nan) * 1e6
+    return raw_dose_on_camera, applied_defocus, stage_x, stage_y
+
+# extract_micrograph_metadata in a worker process, also returning the filesystem calls it made, which are added to the main process count
+def _extract_micrograph_metadata_in_worker(xml_path):
+    start_fs_calls = fs_call_count()
+    return extract_micrograph_metadata(xml_path), fs_call_count() - start_fs_calls
+
+# Parse DoseOnCamera, AppliedDefocus and the stage position for every XML path on a pool of worker processes
+# Missing paths (None) and unreadable files are returned as NaN
+def extract_xml_metadata(xml_paths, workers=1):
+    metadata = np.full((4, len(xml_paths)), np.nan)
+
+    indices = [i for i, xml_path in enumerate(xml_paths) if xml_path is not None]
+    paths = [xml_paths[i] for i in indices]
+    start_time = time.perf_counter()
+
+    if workers > 1 and len(paths) > 1:
+        chunksize = max(1, len(paths) // (workers * 16))
+        with ProcessPoolExecutor(max_workers=workers, initializer=install_fs_call_counter) as executor:
+            results, fs_calls = zip(*executor.map(_extract_micrograph_metadata_in_worker, paths, chunksize=chunksize))
+        count_fs_calls(sum(fs_calls))
+    else:
+        results = [extract_micrograph_metadata(path) for path in paths]
+
+    if results:
+        metadata[:, indices] = np.array(results, dtype=np.float64).T
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Parsed {len(paths)} XML files in {elapsed:.2f} s ({len(paths) / max(elapsed, 1e-9):.0f} files/s, {workers} workers)")
+    raw_dose_on_camera, applied_defocus, stage_x, stage_y = metadata
+    return raw_dose_on_camera, applied_defocus, stage_x, stage_y
+
+## Persistent EPU metadata cache
+
+# EPU metadata never changes after acquisition, so parsed values are cached per XML path and mtime
+METADATA_CACHE_MAX_AGE_DAYS = 365
+METADATA_CACHE_MAX_ENTRIES = 5000000
+SQLITE_BATCH_SIZE = 500
+METADATA_CACHE_VERSION = 2  # Bumped when columns are added, older caches are dropped and rebuilt
+
+# Default cache location, i.e. ~/.cache/particle_distribution/epu_metadata.sqlite
+def default_metadata_cache_path():
+    cache_root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_root, "particle_distribution", "epu_metadata.sqlite")
+
+def open_metadata_cache(cache_path):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    connection = sqlite3.connect(cache_path, timeout=60)
+    if connection.execute("PRAGMA user_version").fetchone()[0] != METADATA_CACHE_VERSION:
+        connection.execute("DROP TABLE IF EXISTS xml_metadata")
+        connection.execute(f"PRAGMA user_version = {METADATA_CACHE_VERSION}")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS xml_metadata ("
+        "path TEXT PRIMARY KEY, mtime REAL, micrograph TEXT, gridsquare TEXT, timestamp TEXT, "
+        "dose_on_camera REAL, applied_defocus REAL, stage_x REAL, stage_y REAL, last_used REAL)"
+    )
+    return connection
+
+# Drop entries unused for longer than the maximum age, then the least recently used entries above the size limit
+def evict_metadata_cache(connection, max_age_days=METADATA_CACHE_MAX_AGE_DAYS, max_entries=METADATA_CACHE_MAX_ENTRIES):
+    connection.execute("DELETE FROM xml_metadata WHERE last_used < ?", (time.time() - max_age_days * 86400,))
+    excess = connection.execute("SELECT COUNT(*) FROM xml_metadata").fetchone()[0] - max_entries
+    if excess > 0:
+        connection.execute(
+            "DELETE FROM xml_metadata WHERE path IN (SELECT path FROM xml_metadata ORDER BY last_used ASC LIMIT ?)",
+            (excess,),
+        )
+    connection.commit()
+
+# Get DoseOnCamera, AppliedDefocus and the stage position for every XML path, only parsing files that are not cached or changed since caching
+# With cache_path None the cache is bypassed, with rebuild_cache every file is parsed again and its cache entry replaced
+def load_xml_metadata(xml_paths, micrograph_names, gridsquares, workers=1, cache_path=None, rebuild_cache=False):
+    if cache_path is None:
+        return extract_xml_metadata(xml_paths, workers)
+
+    raw_dose_on_camera = np.full(len(xml_paths), np.nan)
+    applied_defocus = np.full(len(xml_paths), np.nan)
+    stage_x = np.full(len(xml_paths), np.nan)
+    stage_y = np.full(len(xml_paths), np.nan)
+    mtimes = {}
+    for xml_path in xml_paths:
+        if xml_path is not None:
+            try:
+                mtimes[xml_path] = counted_stat(xml_path).st_mtime
+            except OSError:
+                pass
 
-            if not rawdatapath:
-                raise ValueError("Raw data path not found in workspaces.json.")
-
-        except Exception as e:
-            print("Raw data path not found automatically. Please supply path to raw data in the command (i.e. python particle_distribution.py {job} {rawdatapath})")
-            print(f"Error: {e}")
-
-    ## Create NumPy array
-
-    print(f"Generating NumPy array... (this step will take a few minutes)")
-    
-    try:        
-        # Resolve the true raw data path
-        first_symlink = next(os.scandir(rawdatapath)).path
-        truerawdatapath = os.path.realpath(first_symlink).split("GridSquare")[0]
-
-        # Get all micrograph paths and filter out .xml files
-        micrograph_paths = [
-            path for path in glob.glob(f"{truerawdatapath}/*/Data/FoilHole*Fractions*")
-            if not path.endswith(".xml")
-        ]
-
-        # Function to extract the timestamp from the micrograph name
-        def extract_timestamp(path):
-            match = re.search(r"FoilHole_.*_Data_.*_.*_(\d{8}_\d{6})_Fractions", path)
-            if match:
-                return match.group(1)  # Return the timestamp (YYYYMMDD_HHMMSS)
-            return None
-
-        # Sort micrograph paths by timestamp
-        micrograph_paths = sorted(
-            micrograph_paths,
-            key=lambda path: extract_timestamp(path)  # Sort by extracted timestamp
+    connection = open_metadata_cache(cache_path)
+    try:
+        # Look up cached entries whose mtime still matches
+        cached = {}
+        if not rebuild_cache:
+            paths = list(mtimes)
+            for start in range(0, len(paths), SQLITE_BATCH_SIZE):
+                batch = paths[start:start + SQLITE_BATCH_SIZE]
+                rows = connection.execute(
+                    f"SELECT path, mtime, dose_on_camera, applied_defocus, stage_x, stage_y FROM xml_metadata WHERE path IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+                for path, mtime, dose, defocus, x, y in rows:
+                    if mtime == mtimes[path]:
+                        # SQLite stores NaN as NULL, i.e. for files without a stage position
+                        cached[path] = (dose, defocus, np.nan if x is None else x, np.nan if y is None else y)
+
+        missing = []
+        for i, xml_path in enumerate(xml_paths):
+            if xml_path in cached:
+                raw_dose_on_camera[i], applied_defocus[i], stage_x[i], stage_y[i] = cached[xml_path]
+            elif xml_path is not None:
+                missing.append(i)
+        print(f"Found {len(cached)} of {len(mtimes)} XML files in metadata cache {cache_path}")
+
+        # Parse everything else and store the results that were read successfully
+        if missing:
+            missing_dose, missing_defocus, missing_x, missing_y = extract_xml_metadata([xml_paths[i] for i in missing], workers)
+            raw_dose_on_camera[missing] = missing_dose
+            applied_defocus[missing] = missing_defocus
+            stage_x[missing] = missing_x
+            stage_y[missing] = missing_y
+
+        now = time.time()
+        connection.executemany(
+            "INSERT OR REPLACE INTO xml_metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (xml_paths[i], mtimes[xml_paths[i]], micrograph_names[i], gridsquares[i], extract_timestamp(micrograph_names[i]),
+                 raw_dose_on_camera[i], applied_defocus[i], stage_x[i], stage_y[i], now)
+                for i in missing
+                if xml_paths[i] in mtimes and not np.isnan(raw_dose_on_camera[i]) and not np.isnan(applied_defocus[i])
+            ],
+        )
+        connection.executemany("UPDATE xml_metadata SET last_used = ? WHERE path = ?", [(now, path) for path in cached])
+        connection.commit()
+        evict_metadata_cache(connection)
+    finally:
+        connection.close()
+
+    return raw_dose_on_camera, applied_defocus, stage_x, stage_y
+
+## Micrograph table
+
+# One row per micrograph, stored as aligned typed columns
+# Micrograph and grid square names are categories, referenced by the 1-based micrograph_index and gridsquare_index codes
+# Names are object arrays holding one Python string each, since fixed-width unicode arrays take 4 bytes per character
+# of the longest name (tables loaded with load_results keep the memory-mapped unicode arrays instead)
+@dataclass
+class MicrographTable:
+    micrograph_names: np.ndarray
+    gridsquare_names: np.ndarray
+    micrograph_index: np.ndarray  # int32
+    gridsquare_index: np.ndarray  # int32
+    num_particles: np.ndarray  # uint32
+    transmission: np.ndarray  # float64, NaN if unknown
+    applied_defocus: np.ndarray  # float64 (µm), NaN if unknown
+    stage_x: np.ndarray  # float64 (µm), NaN if unknown
+    stage_y: np.ndarray  # float64 (µm), NaN if unknown
+
+    def __len__(self):
+        return len(self.micrograph_index)
+
+    # Rows matching a boolean mask, sharing the same name categories
+    def select(self, mask):
+        return MicrographTable(
+            micrograph_names=self.micrograph_names,
+            gridsquare_names=self.gridsquare_names,
+            micrograph_index=self.micrograph_index[mask],
+            gridsquare_index=self.gridsquare_index[mask],
+            num_particles=self.num_particles[mask],
+            transmission=self.transmission[mask],
+            applied_defocus=self.applied_defocus[mask],
+            stage_x=self.stage_x[mask],
+            stage_y=self.stage_y[mask],
         )
 
-        # Extract grid squares and group micrographs by grid square
-        grid_square_to_micrographs = {}
-        for path in micrograph_paths:
-            # Extract grid square (GridSquare_*)
-            gridsquare = path.split("Images-Disc1/")[1].split("/Data/")[0]
-            grid_square_to_micrographs.setdefault(gridsquare, []).append(path)
-
-        # Assign grid square indices based on the sorted order of timestamps
-        sorted_grid_squares = list(grid_square_to_micrographs.keys())
-        grid_square_map = {gridsquare: i + 1 for i, gridsquare in enumerate(sorted_grid_squares)}
-
-        # Extract micrograph names and grid squares
-        micrographs, gridsquares = zip(*[
-            (os.path.splitext(path.split("Data/")[1])[0], path.split("Images-Disc1/")[1].split("/Data/")[0])
-            for path in micrograph_paths
-        ])
-
-        # Initialize the NumPy array
-        num_micrographs = len(micrographs)
-        data = np.zeros((num_micrographs, 7), dtype=object)
-
-        # Populate the array
-        for i, (micrograph, gridsquare) in enumerate(zip(micrographs, gridsquares)):
-            data[i] = [micrograph, i + 1, gridsquare, grid_square_map[gridsquare], 0, None, None]  # Initialize particles to 0
-
-        # Read the particles.star file
-        particles_star_path = f"{folder_name}/inputs/particles.star"
-        raw_dose_on_camera_values = []
-
-        if os.path.exists(particles_star_path):
-            with open(particles_star_path, "r") as f:
-                for line in f:
-                    if fnmatch.fnmatch(line, "*@*"):
-                        # Extract the micrograph name from the line
-                        parts = line.split("FoilHole")
-                        if len(parts) > 1:
-                            micrograph_name = parts[1].split("Fractions")[0]
-                            # Match the micrograph name and increment the particle count
-                            for i in range(num_micrographs):
-                                if micrograph_name in data[i, 0]:
-                                    data[i, 4] += 1
-                                    break
-        
-        # Function to extract DoseOnCamera and AppliedDefocus from an XML file
-        def extract_dose_and_defocus(xml_path):
-            try:
-                tree = ET.parse(xml_path)
-                root = tree.getroot()
-                raw_dose_on_camera = float(root[2][0][1].text)  # Extract DoseOnCamera
-                applied_defocus = float(root[2][17][1].text) * 1e6  # Extract AppliedDefocus and convert to correct units
-                return raw_dose_on_camera, applied_defocus
-            except Exception as e:
-                print(f"Error reading XML file {xml_path}: {e}")
-                return None, None
-
-        # Step through each micrograph in the array and populate DoseOnCamera and AppliedDefocus
-        for i in range(num_micrographs):
-            micrograph_name = data[i, 0]  # Get the micrograph name from the array
-            base_micrograph_name = micrograph_name.replace("_Fractions", "")
-        
-            # Find the matching XML file
-            xml_file = glob.glob(f"{truerawdatapath}/*/Data/{base_micrograph_name}.xml")
-
-            if xml_file:
-                # Use the first matching XML file
-                raw_dose_on_camera, applied_defocus = extract_dose_and_defocus(xml_file[0]) # This uses a list and then makes it not a list because I am too lazy to figure out how to do it better
-                data[i, 5] = raw_dose_on_camera  # Populate DoseOnCamera
-                data[i, 6] = applied_defocus  # Populate AppliedDefocus
-                if raw_dose_on_camera is not None:
-                    raw_dose_on_camera_values.append(raw_dose_on_camera)
-                    
+# Build a table for micrographs in acquisition order, with zero particles and unknown transmission / defocus / stage position
+def new_micrograph_table(micrograph_names, gridsquare_names, gridsquare_index):
+    num_micrographs = len(micrograph_names)
+    return MicrographTable(
+        micrograph_names=np.array(list(micrograph_names), dtype=object),
+        gridsquare_names=np.array(list(gridsquare_names), dtype=object),
+        micrograph_index=np.arange(1, num_micrographs + 1, dtype=np.int32),
+        gridsquare_index=np.array(gridsquare_index, dtype=np.int32),
+        num_particles=np.zeros(num_micrographs, dtype=np.uint32),
+        transmission=np.full(num_micrographs, np.nan),
+        applied_defocus=np.full(num_micrographs, np.nan),
+        stage_x=np.full(num_micrographs, np.nan),
+        stage_y=np.full(num_micrographs, np.nan),
+    )
+
+# Add micrographs (in acquisition order, after every existing row) to the end of a table
+# New grid squares get the next grid square indices
+def append_micrograph_rows(table, micrograph_names, gridsquare_names):
+    grid_square_map = {gridsquare: i + 1 for i, gridsquare in enumerate(table.gridsquare_names.tolist())}
+    for gridsquare in gridsquare_names:
+        grid_square_map.setdefault(gridsquare, len(grid_square_map) + 1)
+    new_rows = new_micrograph_table(micrograph_names, list(grid_square_map), [grid_square_map[gridsquare] for gridsquare in gridsquare_names])
+    return MicrographTable(
+        micrograph_names=np.concatenate([table.micrograph_names, new_rows.micrograph_names]),
+        gridsquare_names=new_rows.gridsquare_names,
+        micrograph_index=np.arange(1, len(table) + len(new_rows) + 1, dtype=np.int32),
+        gridsquare_index=np.concatenate([table.gridsquare_index, new_rows.gridsquare_index]),
+        num_particles=np.concatenate([table.num_particles, new_rows.num_particles]),
+        transmission=np.concatenate([table.transmission, new_rows.transmission]),
+        applied_defocus=np.concatenate([table.applied_defocus, new_rows.applied_defocus]),
+        stage_x=np.concatenate([table.stage_x, new_rows.stage_x]),
+        stage_y=np.concatenate([table.stage_y, new_rows.stage_y]),
+    )
+
+# Format a float column the same way as str() of a Python float, with None for missing values
+def format_float_column(values):
+    return ["None" if np.isnan(value) else str(value) for value in values.tolist()]
+
+# Write allmicstats.csv, one line per micrograph
+def save_micrograph_table_csv(table, csv_file_path):
+    columns = [
+        table.micrograph_names[table.micrograph_index - 1].tolist(),
+        table.micrograph_index.tolist(),
+        table.gridsquare_names[table.gridsquare_index - 1].tolist(),
+        table.gridsquare_index.tolist(),
+        table.num_particles.tolist(),
+        format_float_column(table.transmission),
+        format_float_column(table.applied_defocus),
+    ]
+    with open(csv_file_path, "w") as f:
+        f.write("Micrograph Name,Micrograph Index,Grid Square Name,Grid Square Index,Number of Particles\n")
+        for row in zip(*columns):
+            f.write(",".join(map(str, row)) + "\n")
+
+# Write one CSV for several jobs against the same micrographs, with one particle count column per job
+def save_jobs_csv(table, jobs, counts_per_job, csv_file_path):
+    columns = [
+        table.micrograph_names[table.micrograph_index - 1].tolist(),
+        table.micrograph_index.tolist(),
+        table.gridsquare_names[table.gridsquare_index - 1].tolist(),
+        table.gridsquare_index.tolist(),
+        *[np.asarray(counts).tolist() for counts in counts_per_job],
+        format_float_column(table.transmission),
+        format_float_column(table.applied_defocus),
+    ]
+    job_headers = ",".join(f"Number of Particles ({os.path.basename(os.path.normpath(job))})" for job in jobs)
+    with open(csv_file_path, "w") as f:
+        f.write(f"Micrograph Name,Micrograph Index,Grid Square Name,Grid Square Index,{job_headers},Approx. Percent Transmission,Applied Defocus\n")
+        for row in zip(*columns):
+            f.write(",".join(map(str, row)) + "\n")
+
+## Binary results
+
+# allmicstats.npz holds the micrograph table as typed columns next to allmicstats.csv, in an uncompressed archive so it can be memory-mapped
+# The format version is bumped whenever a column is added, renamed, removed or changes meaning
+RESULTS_FORMAT_VERSION = 2
+RESULTS_COLUMNS = {
+    "micrograph_names": "U",  # micrograph names, referenced by micrograph_index
+    "gridsquare_names": "U",  # grid square names, referenced by gridsquare_index
+    "micrograph_index": np.int32,  # 1-based
+    "gridsquare_index": np.int32,  # 1-based
+    "num_particles": np.uint32,
+    "transmission": np.float64,  # approx. percent transmission, NaN if unknown
+    "applied_defocus": np.float64,  # µm, NaN if unknown
+    "stage_x": np.float64,  # µm, NaN if unknown
+    "stage_y": np.float64,  # µm, NaN if unknown
+}
+# Columns added after the first version, filled with NaN when loading older files
+RESULTS_COLUMNS_SINCE = {"stage_x": 2, "stage_y": 2}
+
+# Save the micrograph table to an .npz file, replacing any previous file atomically so readers never see a partial file
+def save_micrograph_table_npz(table, npz_path):
+    columns = {name: np.asarray(getattr(table, name), dtype=dtype) for name, dtype in RESULTS_COLUMNS.items()}
+    temp_path = f"{npz_path}.tmp.npz"
+    np.savez(temp_path, format_version=np.int32(RESULTS_FORMAT_VERSION), **columns)
+    os.replace(temp_path, npz_path)
+
+# Read every array of an uncompressed .npz file as a read-only memory map into the file, without copying
+# Compressed members, empty arrays and scalars are read normally
+def load_npz_arrays(npz_path, mmap=True):
+    arrays = {}
+    with zipfile.ZipFile(npz_path) as archive, open(npz_path, "rb") as f:
+        for info in archive.infolist():
+            name = info.filename[:-len(".npy")] if info.filename.endswith(".npy") else info.filename
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            # Skip the zip local file header to reach the .npy header, then the array data
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
             else:
-                print(f"No matching XML file found for micrograph {micrograph_name}")
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
 
-        if raw_dose_on_camera_values: # Change over to percent transmission from dose
-            max_dose_on_camera = max(raw_dose_on_camera_values)
-            for i in range(num_micrographs):
-                if data[i, 5] is not None:
-                    data[i, 5] = (data[i, 5] / max_dose_on_camera) * 100
-
-    except Exception as e:
-        print(f"Error creating NumPy array: {e}")
+            if dtype.hasobject or not shape or 0 in shape:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+            else:
+                arrays[name] = np.memmap(f, dtype=dtype, mode="r", offset=f.tell(), shape=shape, order="F" if fortran_order else "C")
+    return arrays
+
+# Load the micrograph table saved by a run, given its particle_stats_JXX folder or the .npz file itself
+# Columns are memory-mapped unless mmap is False
+def load_results(folder, mmap=True):
+    npz_path = folder if folder.endswith(".npz") else os.path.join(folder, "output_CSVs", "allmicstats.npz")
+    arrays = load_npz_arrays(npz_path, mmap)
+    format_version = int(arrays.get("format_version", -1))
+    if not 1 <= format_version <= RESULTS_FORMAT_VERSION:
+        raise ValueError(f"{npz_path} has results format version {format_version}, expected 1 to {RESULTS_FORMAT_VERSION}")
+    for name, since in RESULTS_COLUMNS_SINCE.items():
+        if format_version < since:
+            arrays[name] = np.full(len(arrays["micrograph_index"]), np.nan)
+    missing = [name for name in RESULTS_COLUMNS if name not in arrays]
+    if missing:
+        raise ValueError(f"{npz_path} is missing columns: {', '.join(missing)}")
+    return MicrographTable(**{name: arrays[name] for name in RESULTS_COLUMNS})
+
+## Group-by statistics
+
+# Per group count, sum, mean, standard deviation, min / max and fraction of zero values
+@dataclass
+class GroupStats:
+    keys: np.ndarray
+    count: np.ndarray
+    total: np.ndarray
+    mean: np.ndarray
+    std: np.ndarray
+    minimum: np.ndarray
+    maximum: np.ndarray
+    empty_fraction: np.ndarray
+
+# Group values by the unique values of a key column with np.bincount and sorted segments, instead of one mask per group
+# Keys always come from every row, rows outside the optional mask are left out of the statistics
+# Groups left without rows have zero count, mean and std, and NaN min / max
+def group_by(key_column, values, mask=None):
+    keys, codes = np.unique(key_column, return_inverse=True)
+    codes = codes.ravel()
+    values = np.asarray(values, dtype=np.float64)
+    if mask is not None:
+        codes = codes[mask]
+        values = values[mask]
+
+    num_groups = len(keys)
+    count = np.bincount(codes, minlength=num_groups)
+    divisor = np.maximum(count, 1)
+    total = np.bincount(codes, weights=values, minlength=num_groups)
+    mean = total / divisor
+    std = np.sqrt(np.bincount(codes, weights=(values - mean[codes]) ** 2, minlength=num_groups) / divisor)
+    empty_fraction = np.bincount(codes, weights=values == 0, minlength=num_groups) / divisor
+
+    # Sort by group then value, so each group is a contiguous segment starting at its minimum
+    order = np.lexsort((values, codes))
+    sorted_values = values[order]
+    present = count > 0
+    segment_ends = np.cumsum(count)
+    minimum = np.full(num_groups, np.nan)
+    maximum = np.full(num_groups, np.nan)
+    minimum[present] = sorted_values[(segment_ends - count)[present]]
+    maximum[present] = sorted_values[segment_ends[present] - 1]
+
+    return GroupStats(keys, count, total, mean, std, minimum, maximum, empty_fraction)
+
+# All aggregates used by the plots and the output tables, for all micrographs and for non-empty micrographs only
+def aggregate_stats(table):
+    nonempty = table.num_particles > 0
+    everything = np.zeros(len(table), dtype=np.int32)
+    defocus = snap_to_tolerance(table.applied_defocus, DEFOCUS_TOLERANCE_UM)  # Group nearly equal defocus values together
+    stats = {}
+    for suffix, mask in [("", None), ("_noempty", nonempty)]:
+        stats["particles" + suffix] = group_by(table.gridsquare_index, table.num_particles, mask)
+        stats["transmission" + suffix] = group_by(table.gridsquare_index, table.transmission, mask)
+        stats["defocus" + suffix] = group_by(defocus, table.num_particles, mask)
+        stats["overall" + suffix] = group_by(everything, table.num_particles, mask)
+    stats["binned"] = binned_stats(table)
+    stats["neighborhood"] = neighborhood_particle_density(table)
+    return stats
+
+# Write gridsquare_stats.csv, one line per grid square
+def save_gridsquare_stats_csv(table, stats, csv_file_path):
+    particles = stats["particles"]
+    particles_noempty = stats["particles_noempty"]
+    transmission = stats["transmission"]
+    transmission_noempty = stats["transmission_noempty"]
+    columns = [
+        particles.keys.tolist(),
+        table.gridsquare_names[particles.keys - 1].tolist(),
+        particles.count.tolist(),
+        particles_noempty.count.tolist(),
+        format_float_column(100 * particles.empty_fraction),
+        particles.total.astype(np.int64).tolist(),
+        format_float_column(particles.mean),
+        format_float_column(particles.std),
+        particles.minimum.astype(np.int64).tolist(),
+        particles.maximum.astype(np.int64).tolist(),
+        format_float_column(particles_noempty.mean),
+        format_float_column(particles_noempty.std),
+        format_float_column(transmission.mean),
+        format_float_column(transmission.std),
+        format_float_column(transmission_noempty.mean),
+        format_float_column(transmission_noempty.std),
+    ]
+    with open(csv_file_path, "w") as f:
+        f.write(
+            "Grid Square Index,Grid Square Name,Micrographs,Non-empty Micrographs,Percent Empty,Total Particles,"
+            "Average Particles,Std Particles,Min Particles,Max Particles,Average Particles (No Empty),Std Particles (No Empty),"
+            "Average Transmission,Std Transmission,Average Transmission (No Empty),Std Transmission (No Empty)\n"
+        )
+        for row in zip(*columns):
+            f.write(",".join(map(str, row)) + "\n")
+
+## Binned statistics
+
+# Bins shared by the binned tables and density plots, so their size does not depend on the number of micrographs
+TRANSMISSION_BIN_WIDTH = 5.0  # percent
+DEFOCUS_TOLERANCE_UM = 1e-3  # applied defocus values closer than this are one setting (float noise, far below any defocus step)
+NUM_PARTICLE_BINS = 30
+
+# Snap values to bins of nearly equal values: in sorted order, a new bin starts at the first value more than tolerance above
+# the start of the current bin, and every value is replaced by that first value (rounded to drop float noise)
+# NaN values stay NaN
+def snap_to_tolerance(values, tolerance):
+    values = np.asarray(values, dtype=np.float64)
+    snapped = np.full(len(values), np.nan)
+    finite = np.isfinite(values)
+    unique_values, codes = np.unique(values[finite], return_inverse=True)
+    if not len(unique_values):
+        return snapped
+
+    bin_starts = []
+    bin_start = unique_values[0]
+    for value in unique_values.tolist():
+        if value - bin_start > tolerance:
+            bin_start = value
+        bin_starts.append(bin_start)
+    snapped[finite] = np.round(bin_starts, 6)[codes.ravel()]
+    return snapped
+
+# Micrograph counts and particle statistics on fixed bins, computed with one np.bincount per statistic over all micrographs
+# yield_* arrays are indexed [transmission bin, defocus bin], density is indexed [grid square, transmission bin, particle bin]
+@dataclass
+class BinnedStats:
+    transmission_edges: np.ndarray
+    defocus_keys: np.ndarray
+    particle_edges: np.ndarray
+    yield_count: np.ndarray
+    yield_nonempty: np.ndarray
+    yield_total: np.ndarray
+    yield_mean: np.ndarray
+    yield_std: np.ndarray
+    density: np.ndarray
+
+# Bin index of every value for the given edges, with the last bin closed on the right and -1 for values outside or NaN
+def bin_codes(values, edges):
+    codes = np.searchsorted(edges, values, side="right") - 1
+    codes[values == edges[-1]] = len(edges) - 2
+    codes[~((values >= edges[0]) & (values <= edges[-1]))] = -1
+    return codes
+
+def binned_stats(table):
+    num_grids = len(table.gridsquare_names)
+    num_particles = table.num_particles.astype(np.float64)
+    transmission_edges = np.arange(0, 100 + TRANSMISSION_BIN_WIDTH, TRANSMISSION_BIN_WIDTH)
+    particle_bin_width = max(1, int(np.ceil((num_particles.max() + 1) / NUM_PARTICLE_BINS))) if len(table) else 1
+    particle_edges = np.arange(NUM_PARTICLE_BINS + 1) * particle_bin_width
+    defocus = snap_to_tolerance(table.applied_defocus, DEFOCUS_TOLERANCE_UM)
+    defocus_keys = np.unique(defocus[np.isfinite(defocus)])
+
+    transmission_codes = bin_codes(table.transmission, transmission_edges)
+    defocus_codes = np.searchsorted(defocus_keys, defocus)
+    defocus_codes[~np.isfinite(defocus)] = -1
+    particle_codes = bin_codes(num_particles, particle_edges)
+    num_transmission_bins = len(transmission_edges) - 1
+    num_defocus_bins = len(defocus_keys)
+
+    # Particle yield per transmission and defocus bin
+    binned = (transmission_codes >= 0) & (defocus_codes >= 0)
+    cells = (transmission_codes * num_defocus_bins + defocus_codes)[binned]
+    values = num_particles[binned]
+    shape = (num_transmission_bins, num_defocus_bins)
+    num_cells = num_transmission_bins * num_defocus_bins
+    yield_count = np.bincount(cells, minlength=num_cells)
+    yield_total = np.bincount(cells, weights=values, minlength=num_cells)
+    yield_mean = np.divide(yield_total, yield_count, out=np.full(num_cells, np.nan), where=yield_count > 0)
+    yield_squares = np.bincount(cells, weights=(values - np.nan_to_num(yield_mean)[cells]) ** 2, minlength=num_cells)
+    yield_std = np.sqrt(np.divide(yield_squares, yield_count, out=np.full(num_cells, np.nan), where=yield_count > 0))
+    yield_nonempty = np.bincount(cells, weights=values > 0, minlength=num_cells).astype(np.int64)
+
+    # Micrographs per grid square, transmission bin and particle bin
+    binned = (transmission_codes >= 0) & (particle_codes >= 0)
+    cells = (((table.gridsquare_index.astype(np.int64) - 1) * num_transmission_bins + transmission_codes) * NUM_PARTICLE_BINS + particle_codes)[binned]
+    density = np.bincount(cells, minlength=num_grids * num_transmission_bins * NUM_PARTICLE_BINS)
+
+    return BinnedStats(
+        transmission_edges=transmission_edges,
+        defocus_keys=defocus_keys,
+        particle_edges=particle_edges,
+        yield_count=yield_count.reshape(shape),
+        yield_nonempty=yield_nonempty.reshape(shape),
+        yield_total=yield_total.reshape(shape),
+        yield_mean=yield_mean.reshape(shape),
+        yield_std=yield_std.reshape(shape),
+        density=density.reshape(num_grids, num_transmission_bins, NUM_PARTICLE_BINS),
+    )
+
+# Write binned_transmission_defocus.csv, one line per transmission and defocus bin with micrographs
+def save_binned_yield_csv(stats, csv_file_path):
+    binned = stats["binned"]
+    transmission_bins, defocus_bins = np.nonzero(binned.yield_count)
+    columns = [
+        binned.transmission_edges[transmission_bins].tolist(),
+        binned.transmission_edges[transmission_bins + 1].tolist(),
+        binned.defocus_keys[defocus_bins].tolist(),
+        binned.yield_count[transmission_bins, defocus_bins].tolist(),
+        binned.yield_nonempty[transmission_bins, defocus_bins].tolist(),
+        binned.yield_total[transmission_bins, defocus_bins].astype(np.int64).tolist(),
+        format_float_column(binned.yield_mean[transmission_bins, defocus_bins]),
+        format_float_column(binned.yield_std[transmission_bins, defocus_bins]),
+    ]
+    with open(csv_file_path, "w") as f:
+        f.write(
+            "Transmission Bin Start,Transmission Bin End,Applied Defocus,Micrographs,Non-empty Micrographs,"
+            "Total Particles,Average Particles,Std Particles\n"
+        )
+        for row in zip(*columns):
+            f.write(",".join(map(str, row)) + "\n")
+
+# Write binned_particles_vs_transmission.csv, one line per grid square, transmission bin and particle bin with micrographs
+def save_binned_density_csv(stats, csv_file_path):
+    binned = stats["binned"]
+    grids, transmission_bins, particle_bins = np.nonzero(binned.density)
+    columns = [
+        (grids + 1).tolist(),
+        binned.transmission_edges[transmission_bins].tolist(),
+        binned.transmission_edges[transmission_bins + 1].tolist(),
+        binned.particle_edges[particle_bins].tolist(),
+        binned.particle_edges[particle_bins + 1].tolist(),
+        binned.density[grids, transmission_bins, particle_bins].tolist(),
+    ]
+    with open(csv_file_path, "w") as f:
+        f.write("Grid Square Index,Transmission Bin Start,Transmission Bin End,Particles Bin Start,Particles Bin End,Micrographs\n")
+        for row in zip(*columns):
+            f.write(",".join(map(str, row)) + "\n")
+
+## Spatial statistics
+
+# Neighborhood radius (µm) around each micrograph's stage position, a few holes on common holey grids
+SPATIAL_RADIUS_UM = 10.0
+SPATIAL_QUERY_CHUNK = 20000
+
+# Points hashed into square cells per group (grid square), so neighbors are only looked up in the 3x3 adjacent cells
+# Cell coordinates are padded by one cell on each side so that adjacent cell keys never wrap into another row or group
+@dataclass
+class SpatialHash:
+    cell_size: float
+    num_x: int
+    num_y: int
+    cells: np.ndarray  # int64 cell key of every point
+    order: np.ndarray  # points sorted by cell key
+    sorted_cells: np.ndarray
+
+def build_spatial_hash(group, x, y, cell_size):
+    if not len(x):
+        empty = np.array([], dtype=np.int64)
+        return SpatialHash(cell_size, 1, 1, empty, empty, empty)
+    cell_x = np.floor((x - x.min()) / cell_size).astype(np.int64) + 1
+    cell_y = np.floor((y - y.min()) / cell_size).astype(np.int64) + 1
+    num_x = int(cell_x.max()) + 2
+    num_y = int(cell_y.max()) + 2
+    cells = (np.asarray(group, dtype=np.int64) * num_y + cell_y) * num_x + cell_x
+    order = np.argsort(cells, kind="stable")
+    return SpatialHash(cell_size, num_x, num_y, cells, order, cells[order])
+
+# Number of points within radius of every point (including itself) and the sum of their values
+# The radius must not be larger than the cell size of the hash
+def neighborhood_sums(spatial_hash, x, y, values, radius):
+    counts = np.zeros(len(x), dtype=np.int64)
+    sums = np.zeros(len(x))
+    for start in range(0, len(x), SPATIAL_QUERY_CHUNK):
+        points = np.arange(start, min(start + SPATIAL_QUERY_CHUNK, len(x)))
+        for offset_y in (-1, 0, 1):
+            for offset_x in (-1, 0, 1):
+                # Candidate neighbors are the runs of points in the adjacent cell, in sorted order
+                neighbor_cells = spatial_hash.cells[points] + offset_y * spatial_hash.num_x + offset_x
+                run_starts = np.searchsorted(spatial_hash.sorted_cells, neighbor_cells, side="left")
+                run_lengths = np.searchsorted(spatial_hash.sorted_cells, neighbor_cells, side="right") - run_starts
+                first = np.repeat(points, run_lengths)
+                offsets = np.arange(len(first)) - np.repeat(np.cumsum(run_lengths) - run_lengths, run_lengths)
+                second = spatial_hash.order[np.repeat(run_starts, run_lengths) + offsets]
+
+                close = (x[first] - x[second]) ** 2 + (y[first] - y[second]) ** 2 <= radius ** 2
+                counts += np.bincount(first[close], minlength=len(x))
+                sums += np.bincount(first[close], weights=values[second[close]], minlength=len(x))
+    return counts, sums
+
+# Particles around each micrograph, from the micrographs of the same grid square within the radius of its stage position
+@dataclass
+class NeighborhoodStats:
+    radius: float
+    neighbors: np.ndarray  # micrographs within the radius, including itself, 0 without a stage position
+    density: np.ndarray  # average particles per micrograph within the radius, NaN without a stage position
+
+def neighborhood_particle_density(table, radius=SPATIAL_RADIUS_UM):
+    neighbors = np.zeros(len(table), dtype=np.int64)
+    density = np.full(len(table), np.nan)
+    located = np.flatnonzero(np.isfinite(table.stage_x) & np.isfinite(table.stage_y))
+    if len(located):
+        x = table.stage_x[located]
+        y = table.stage_y[located]
+        spatial_hash = build_spatial_hash(table.gridsquare_index[located], x, y, radius)
+        counts, sums = neighborhood_sums(spatial_hash, x, y, table.num_particles[located].astype(np.float64), radius)
+        neighbors[located] = counts
+        density[located] = sums / counts
+    return NeighborhoodStats(radius, neighbors, density)
+
+# Write spatial_stats.csv, one line per micrograph with its stage position and neighborhood
+def save_spatial_stats_csv(table, stats, csv_file_path):
+    neighborhood = stats["neighborhood"]
+    columns = [
+        table.micrograph_names[table.micrograph_index - 1].tolist(),
+        table.micrograph_index.tolist(),
+        table.gridsquare_index.tolist(),
+        format_float_column(table.stage_x),
+        format_float_column(table.stage_y),
+        table.num_particles.tolist(),
+        neighborhood.neighbors.tolist(),
+        format_float_column(neighborhood.density),
+    ]
+    with open(csv_file_path, "w") as f:
+        f.write(
+            "Micrograph Name,Micrograph Index,Grid Square Index,Stage X (um),Stage Y (um),Number of Particles,"
+            f"Micrographs Within {neighborhood.radius:g} um,Neighborhood Average Particles\n"
+        )
+        for row in zip(*columns):
+            f.write(",".join(map(str, row)) + "\n")
 
-    ## Save arrays
+## CryoSPARC .cs particle files
 
-    # Save the main array as a .csv file
-    csv_file_path = f"{folder_name}/output_CSVs/allmicstats.csv"
-    np.savetxt(csv_file_path, data, delimiter=",", fmt="%s", header="Micrograph Name,Micrograph Index,Grid Square Name,Grid Square Index,Number of Particles", comments="")
-    print(f"Saved main array to {csv_file_path}")
+CS_MICROGRAPH_FIELD = "location/micrograph_path"
 
-    # Use grid_square_map to create the grid square indices table
-    txt_file_path = f"{folder_name}/output_CSVs/gridsquareindices.txt"
-    with open(txt_file_path, "w") as f:
-        f.write("Grid Square Index\tGrid Square Name\n")
-        for grid_square_name, grid_square_index in sorted(grid_square_map.items(), key=lambda x: x[1]):
-            f.write(f"{grid_square_index}\t{grid_square_name}\n")
-    print(f"Saved grid square indices to {txt_file_path}")
+# Find the particle .cs files written by a CryoSPARC job, newest version of each output first
+def find_particle_cs_files(job):
+    cs_paths = []
+    try:
+        with open(os.path.join(job, "job.json"), "r") as job_file:
+            job_data = json.load(job_file)
+        for output in job_data.get("output_results", []):
+            group_name = output.get("group_name", "")
+            if not group_name.startswith("particles") or "excluded" in group_name or "rejected" in group_name:
+                continue
+            if output.get("metafiles"):
+                cs_paths.append(os.path.join(job, "..", output["metafiles"][-1]))
+    except (OSError, ValueError):
+        pass
 
-    ## Make graphs
-
-    print(f"Generating plots...")
-
-    # Extract columns from the NumPy array and make color list
-    grid_square_indices = data[:, 3].astype(int)
-    num_particles = data[:, 4].astype(int)
-    tableau_colors = plt.cm.tab20.colors
-
-    # Helper function to calculate averages and standard deviations
-    def calculate_avg_and_std(grid_indices, particles, include_empty=True):
-        unique_grids = np.unique(grid_indices)
-        averages = []
-        std_devs = []
-        for grid in unique_grids:
-            particles_in_grid = particles[grid_indices == grid]
-            if not include_empty:
-                particles_in_grid = particles_in_grid[particles_in_grid > 0]
-            averages.append(np.mean(particles_in_grid) if len(particles_in_grid) > 0 else 0)
-            std_devs.append(np.std(particles_in_grid) if len(particles_in_grid) > 0 else 0)
-
-        # Calculate overall average and stdev
-        if include_empty:
-            overall_particles = num_particles
-        else:
-            overall_particles = num_particles[num_particles > 0]
-        overall_average = np.mean(overall_particles)
-        overall_std = np.std(overall_particles)
+    # Fall back to whatever particle files are in the job directory
+    if not cs_paths:
+        cs_paths = sorted(
+            path for path in glob.glob(os.path.join(job, "*particles*.cs"))
+            if "excluded" not in os.path.basename(path) and "rejected" not in os.path.basename(path)
+        )
 
-        averages.append(overall_average)
-        std_devs.append(overall_std)
-        
-        return unique_grids, np.array(averages), np.array(std_devs)
+    return [path for path in cs_paths if os.path.exists(path)]
+
+# Stream one field of a .cs structured array in chunks, memory-mapping the file so other fields are never read
+# Rows before start_row are skipped, i.e. when they were already read by a previous call
+def iter_cs_field(cs_path, field, chunk_size=1000000, start_row=0):
+    particles = np.load(cs_path, mmap_mode="r")
+    if particles.dtype.names is None or field not in particles.dtype.names:
+        raise KeyError(f"{field} not found in {cs_path}")
+    column = particles[field]
+    for start in range(start_row, len(column), chunk_size):
+        yield np.asarray(column[start:start + chunk_size])
+
+# First particle .cs file of the job that can be memory-mapped and has micrograph paths, or None
+def find_readable_particle_cs_file(job):
+    for cs_path in find_particle_cs_files(job):
+        try:
+            particles = np.load(cs_path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            print(f"Could not memory-map {cs_path}: {e}")
+            continue
+        if particles.dtype.names is not None and CS_MICROGRAPH_FIELD in particles.dtype.names:
+            return cs_path
+    return None
+
+# Count particles per micrograph straight from the job's .cs files, returns None if no usable file is found
+def count_particles_from_cs(job, micrograph_names):
+    cs_path = find_readable_particle_cs_file(job)
+    if cs_path is None:
+        return None
+    print(f"Counting particles from {cs_path}")
+    return count_particles_per_micrograph(iter_cs_field(cs_path, CS_MICROGRAPH_FIELD), micrograph_names)
+
+# Batches of particle micrograph names for the job, from particles.star written by cs2star
+def iter_particle_micrographs_star(job, folder_name):
+    subprocess.run(["cs2star", "-f", job, f"{folder_name}/inputs"])
 
-    # Average particles per micrograph bar graphs
+    particles_star_path = f"{folder_name}/inputs/particles.star"
+    if not os.path.exists(particles_star_path):
+        return
+    # Prefer the micrograph column, but fall back to the particle image names (both carry the FoilHole stem)
+    for batch in iter_star_columns(particles_star_path, ["_rlnMicrographName", "_rlnImageName"]):
+        yield batch.get("_rlnMicrographName", batch.get("_rlnImageName"))
+
+## Plots
+
+TABLEAU_COLORS = plt.cm.tab20.colors
+
+# Map grid square indices to tableau colors, in order of the unique grid squares present
+def gridsquare_color_map(grid_square_indices):
+    return {grid: TABLEAU_COLORS[i % len(TABLEAU_COLORS)] for i, grid in enumerate(np.unique(grid_square_indices).tolist())}
+
+# Draw one bar per x value as a single PolyCollection, which renders much faster than one Rectangle artist per bar
+def plot_bar_collection(ax, x, heights, colors, width=0.8):
+    x = np.asarray(x, dtype=np.float64)
+    heights = np.asarray(heights, dtype=np.float64)
+    left = x - width / 2
+    right = x + width / 2
+    bottom = np.zeros_like(heights)
+    vertices = np.stack([
+        np.column_stack([left, bottom]),
+        np.column_stack([left, heights]),
+        np.column_stack([right, heights]),
+        np.column_stack([right, bottom]),
+    ], axis=1)
+    bars = PolyCollection(vertices, facecolors=colors, edgecolors=colors)
+    bars.sticky_edges.y.append(0)  # Keep the bars on the x-axis, like plt.bar
+    ax.add_collection(bars)
+    ax.autoscale_view()
+    return bars
+
+# Average particles per micrograph bar graphs
+def plot_avg_particles(table, stats, folder_name):
     for include_empty, filename in [(True, "avg_particles_allmics.png"), (False, "avg_particles_noempty.png")]:
-        unique_grids, averages, std_devs = calculate_avg_and_std(grid_square_indices, num_particles, include_empty)
+        suffix = "" if include_empty else "_noempty"
+        grid_stats = stats["particles" + suffix]
+        overall = stats["overall" + suffix]
+        unique_grids = grid_stats.keys
+        averages = np.append(grid_stats.mean, overall.mean)
+        std_devs = np.append(grid_stats.std, overall.std)
 
         x_values = np.arange(len(unique_grids) + 1)
         x_labels = list(unique_grids) + ["All"]
@@ -273,13 +995,10 @@ def main():
         plt.savefig(f"{folder_name}/{filename}")
         plt.close()
 
-    # Percentage of empty micrographs per grid square
-    unique_grids = np.unique(grid_square_indices)
-    percent_empty = []
-    for grid in unique_grids:
-        particles_in_grid = num_particles[grid_square_indices == grid]
-        percent_empty.append(100 * np.sum(particles_in_grid == 0) / len(particles_in_grid))
-    plt.figure(figsize=(10, 6))
+# Percentage of empty micrographs per grid square
+def plot_percent_empty(table, stats, folder_name):
+    unique_grids = stats["particles"].keys
+    percent_empty = 100 * stats["particles"].empty_fraction
     plt.figure()
     plt.bar(unique_grids, percent_empty, color="mediumpurple", edgecolor="black")
     plt.xlabel("Grid Square Index")
@@ -289,11 +1008,10 @@ def main():
     plt.savefig(f"{folder_name}/percent_empty.png")
     plt.close()
 
-    # Total sum of particles per grid square
-    total_particles = []
-    for grid in unique_grids:
-        particles_in_grid = num_particles[grid_square_indices == grid]
-        total_particles.append(np.sum(particles_in_grid))
+# Total sum of particles per grid square
+def plot_total_particles(table, stats, folder_name):
+    unique_grids = stats["particles"].keys
+    total_particles = stats["particles"].total
     plt.figure(figsize=(10, 6))
     plt.bar(unique_grids, total_particles, color="darkseagreen", edgecolor="black")
     plt.xticks(unique_grids)
@@ -302,48 +1020,45 @@ def main():
     plt.savefig(f"{folder_name}/total_particles.png")
     plt.close()
 
-    # Histogram of particles per micrograph
+# Histogram of particles per micrograph
+def plot_distribution_particles_per_mic(table, stats, folder_name):
     plt.figure(figsize=(10, 6))
-    plt.hist(num_particles, bins=20, color="orange", edgecolor="black")
+    plt.hist(table.num_particles, bins=20, color="orange", edgecolor="black")
     plt.xlabel("Number of Particles per Micrograph")
     plt.ylabel("Number of Micrographs")
     plt.savefig(f"{folder_name}/distribution_particles_per_mic.png")
     plt.close()
-    
-    # Clustered bar graphs of particles per micrograph
+
+# Clustered bar graphs of particles per micrograph
+def plot_particles_per_mic(table, stats, folder_name):
     for include_empty, filename in [(True, "particles_per_mic_allmics.png"), (False, "particles_per_mic_noempty.png")]:
         # Filter data based on whether empty micrographs are included
-        filtered_data = data if include_empty else data[data[:, 4].astype(int) > 0]
+        filtered_table = table if include_empty else table.select(table.num_particles > 0)
 
         # Extract relevant columns
-        grid_square_indices = filtered_data[:, 3].astype(int)
-        num_particles_filtered = filtered_data[:, 4].astype(int)  # Use a distinct variable name to avoid conflicts
-
-        # Create a color map for grid square indices
-        unique_grids_clustered = np.unique(grid_square_indices)
-        color_map = {grid: tableau_colors[i % len(tableau_colors)] for i, grid in enumerate(unique_grids_clustered)}
+        grid_square_indices = filtered_table.gridsquare_index
+        num_particles_filtered = filtered_table.num_particles  # Use a distinct variable name to avoid conflicts
 
         # Map micrograph indices to a continuous range
-        continuous_x = np.arange(len(filtered_data))  # Continuous x-axis for the bars
+        unique_grids_clustered = np.unique(grid_square_indices)
+        continuous_x = np.arange(len(filtered_table))  # Continuous x-axis for the bars
 
-        # Plot the bars
+        # Plot all bars as a single collection of rectangles with the same geometry as plt.bar (width 0.8)
+        grid_positions = np.searchsorted(unique_grids_clustered, grid_square_indices)
+        bar_colors = np.array(TABLEAU_COLORS)[grid_positions % len(TABLEAU_COLORS)]
         plt.figure(figsize=(12, 6))
-        for x, grid_square_index, particles in zip(continuous_x, grid_square_indices, num_particles_filtered):
-            plt.bar(x, particles, color=color_map[grid_square_index], edgecolor=color_map[grid_square_index])
+        plot_bar_collection(plt.gca(), continuous_x, num_particles_filtered, bar_colors)
 
         # Set x-axis labels to represent grid square indices
-        # Group micrograph indices by grid square index for labeling
-        grid_square_labels = []
-        for grid in unique_grids_clustered:
-            # Find the range of continuous x values for this grid square
-            indices_in_grid = continuous_x[grid_square_indices == grid]
-            if len(indices_in_grid) > 0:
-                mid_index = (indices_in_grid[0] + indices_in_grid[-1]) / 2  # Use the midpoint of indices for the label
-                grid_square_labels.append((mid_index, grid))
+        # Use the midpoint between the first and last micrograph of each grid square for the label
+        first_indices = np.unique(grid_square_indices, return_index=True)[1]
+        last_indices = len(grid_square_indices) - 1 - np.unique(grid_square_indices[::-1], return_index=True)[1]
+        grid_square_labels = list(zip((continuous_x[first_indices] + continuous_x[last_indices]) / 2, unique_grids_clustered))
 
         # Apply labels to the x-axis
-        label_positions, label_values = zip(*grid_square_labels)
-        plt.xticks(label_positions, label_values)
+        if grid_square_labels:
+            label_positions, label_values = zip(*grid_square_labels)
+            plt.xticks(label_positions, label_values)
 
         # Add labels and title
         plt.xlabel("Grid Square Index")
@@ -353,24 +1068,15 @@ def main():
         plt.savefig(f"{folder_name}/{filename}")
         plt.close()
 
-    # Applied Defocus vs. Average Number of Particles Bar Graph
-
+# Applied Defocus vs. Average Number of Particles Bar Graph
+def plot_particles_vs_defocus(table, stats, folder_name):
     for include_empty, filename in [(True, "particles_vs_defocus_allmics.png"), (False, "particles_vs_defocus_noempty.png")]:
-        # Filter data based on whether empty micrographs are included
-        filtered_data = data if include_empty else data[data[:, 4].astype(int) > 0]
-
-        applied_defocus = filtered_data[:, 6].astype(float)  # Column 6: AppliedDefocus
-        num_particles = filtered_data[:, 4].astype(float)   # Column 4: Number of Particles
-
-        # Group by unique AppliedDefocus values
-        unique_defocus = np.unique(applied_defocus)
-        avg_particles = []
-        std_particles = []
-
-        for defocus in unique_defocus:
-            particles_in_group = num_particles[applied_defocus == defocus]
-            avg_particles.append(np.mean(particles_in_group))
-            std_particles.append(np.std(particles_in_group))
+        # Group by unique AppliedDefocus values, leaving out micrographs with unknown (NaN) defocus
+        defocus_stats = stats["defocus" + ("" if include_empty else "_noempty")]
+        present = (defocus_stats.count > 0) & np.isfinite(defocus_stats.keys)
+        unique_defocus = defocus_stats.keys[present]
+        avg_particles = defocus_stats.mean[present]
+        std_particles = defocus_stats.std[present]
 
         yerr_positive = np.array([np.zeros_like(std_particles), std_particles])
 
@@ -383,24 +1089,15 @@ def main():
         plt.savefig(f"{folder_name}/{filename}")
         plt.close()
 
-    # Bar Graph of Average Percent Transmission for Each Grid Square
-
+# Bar Graph of Average Percent Transmission for Each Grid Square
+def plot_transmission_vs_gridsquare(table, stats, folder_name):
     for include_empty, filename in [(True, "transmission_vs_gridsquare_allmics.png"), (False, "transmission_vs_gridsquare_noempty.png")]:
-
-        filtered_data = data if include_empty else data[data[:, 4].astype(int) > 0]
-
-        transmission = filtered_data[:, 5].astype(float)  # Column 5: Transmission (approx.)
-        grid_square_index = filtered_data[:, 3].astype(int)  # Column 3: GridSquareIndex
-
-        # Group by unique AppliedDefocus values
-        unique_gridsquare = np.unique(grid_square_index)
-        avg_trans = []
-        std_trans = []
-
-        for index_step in unique_gridsquare:
-            group_transmission = transmission[grid_square_index == index_step]
-            avg_trans.append(np.mean(group_transmission))
-            std_trans.append(np.std(group_transmission))
+        # Group by grid square, skipping grid squares without any micrographs left
+        transmission_stats = stats["transmission" + ("" if include_empty else "_noempty")]
+        present = transmission_stats.count > 0
+        unique_gridsquare = transmission_stats.keys[present]
+        avg_trans = transmission_stats.mean[present]
+        std_trans = transmission_stats.std[present]
 
         yerr_positive = np.array([np.zeros_like(std_trans), std_trans])
 
@@ -410,56 +1107,894 @@ def main():
         plt.xticks(unique_gridsquare)
         plt.xlabel("Grid Square Index")
         plt.ylabel("Approx. Percent Transmission\n" + ("(All Micrographs)" if include_empty else "(No Empty Micrographs)") + " + Standard Deviation")
-        plt.savefig(f"{folder_name}/{filename}")    
+        plt.savefig(f"{folder_name}/{filename}")
         plt.close()
 
-    # Scatterplots of Percent Transmission vs. Number of Particles
-
-    transmission = data[:, 5].astype(float)  # Column 5: Transmission (approx.)
-    num_particles = data[:, 4].astype(float)   # Column 4: Number of Particles
-    grid_square_index = data[:, 3].astype(int)  # Column 3: GridSquareIndex
+# Scatterplot of Percent Transmission vs. Number of Particles, color-coded by grid square
+def plot_particles_vs_transmission(table, stats, folder_name):
+    color_map = gridsquare_color_map(table.gridsquare_index)
+    gridsquare_colors = np.array([color_map[grid] for grid in table.gridsquare_index.tolist()]).reshape(-1, 3)
 
-    gridsquare_colors = [color_map[entry] for entry in grid_square_index]
-
-    # Overall scatterplot
     plt.figure(figsize=(10, 6))
-    scatter = plt.scatter(transmission, num_particles, c=gridsquare_colors, edgecolor=None)
+    plt.scatter(table.transmission, table.num_particles, c=gridsquare_colors, edgecolor=None)
     plt.xlabel("Approximate Percent Transmission")
     plt.ylabel("Number of Particles in Micrograph")
     plt.grid(alpha=0.25)
 
-    unique_grids = np.unique(grid_square_index)
-    for grid in unique_grids:
-        plt.scatter([], [], color=color_map[grid], label=f"Grid Square {grid}")
+    for grid, color in color_map.items():
+        plt.scatter([], [], color=color, label=f"Grid Square {grid}")
     plt.legend(title="Grid Square Index", loc="upper left")
 
     plt.savefig(f"{folder_name}/particles_vs_transmission.png")
+    plt.close()
+
+# Scatterplot of Percent Transmission vs. Number of Particles for a single grid square
+def plot_particles_vs_transmission_gridsquare(table, stats, folder_name, grid):
+    color = gridsquare_color_map(table.gridsquare_index)[grid]
+    gridsq_table = table.select(table.gridsquare_index == grid)
+
+    plt.figure(figsize=(10, 6))
+    plt.scatter(gridsq_table.transmission, gridsq_table.num_particles, c=[color] * len(gridsq_table), edgecolor=None)
+    plt.xlabel("Approximate Transmission")
+    plt.ylabel("Number of Particles in Micrograph")
+    plt.grid(alpha=0.25)
 
-    # Per grid square
-    grid_square_index = data[:, 3].astype(int)  # Column 3: GridSquareIndex
-    unique_grid_squares = np.unique(grid_square_index)
-
-    for grid in unique_grid_squares:
-        gridsq_data = data[data[:, 3].astype(int) == grid]
-        transmission = gridsq_data[:, 5].astype(float)  # Column 5: DoseOnCamera
-        num_particles = gridsq_data[:, 4].astype(float)   # Column 4: Number of Particles
-        grid_square_index = gridsq_data[:, 3].astype(int)  # Column 3: GridSquareIndex
-        gridsquare_colors = [color_map[entry] for entry in grid_square_index]
-        
-        plt.figure(figsize=(10, 6))
-        scatter = plt.scatter(transmission, num_particles, c=gridsquare_colors, edgecolor=None)
-        plt.xlabel("Approximate Transmission")
-        plt.ylabel("Number of Particles in Micrograph")
-        plt.grid(alpha=0.25)
-
-        plt.scatter([], [], color=color_map[grid], label=f"Grid Square {grid}")
+    plt.scatter([], [], color=color, label=f"Grid Square {grid}")
+    plt.legend(loc="upper left")
+
+    os.makedirs(f"{folder_name}/particles_vs_transmission_gridsquares", exist_ok=True)
+    plt.savefig(f"{folder_name}/particles_vs_transmission_gridsquares/particles_vs_transmission_sq{grid}.png")
+    plt.close()
+
+# Stage position heatmaps of particles per micrograph and of the neighborhood average, for a single grid square
+def plot_spatial_density_gridsquare(table, stats, folder_name, grid):
+    in_grid = table.gridsquare_index == grid
+    gridsq_table = table.select(in_grid)
+    density = stats["neighborhood"].density[in_grid]
+    located = np.isfinite(gridsq_table.stage_x) & np.isfinite(gridsq_table.stage_y)
+    x = gridsq_table.stage_x[located]
+    y = gridsq_table.stage_y[located]
+    num_particles = gridsq_table.num_particles[located]
+    vmax = max(1, int(num_particles.max())) if len(num_particles) else 1
+
+    fig, axes = plt.subplots(1, 2, figsize=(14, 6))
+    for ax, values, title in [
+        (axes[0], num_particles, "Particles per Micrograph"),
+        (axes[1], density[located], f"Average Particles per Micrograph within {stats['neighborhood'].radius:g} µm"),
+    ]:
+        points = ax.scatter(x, y, c=values, cmap="viridis", vmin=0, vmax=vmax, s=25, edgecolor=None)
+        fig.colorbar(points, ax=ax)
+        ax.set_aspect("equal", adjustable="datalim")
+        ax.set_xlabel("Stage X (µm)")
+        ax.set_ylabel("Stage Y (µm)")
+        ax.set_title(title)
+    fig.suptitle(f"Grid Square {grid}")
+
+    os.makedirs(f"{folder_name}/spatial_density_gridsquares", exist_ok=True)
+    fig.savefig(f"{folder_name}/spatial_density_gridsquares/spatial_density_sq{grid}.png")
+    plt.close(fig)
+
+# Particles per micrograph over the session, in acquisition order, with a rolling average
+def plot_particles_vs_time(table, stats, folder_name, window=50):
+    times = acquisition_times(table.micrograph_names[table.micrograph_index - 1].tolist())
+    known = ~np.isnat(times)
+    hours = (times[known] - times[known].min()).astype(np.float64) / 3600 if known.any() else np.array([])
+    num_particles = table.num_particles[known].astype(np.float64)
+    order = np.argsort(hours, kind="stable")
+    hours = hours[order]
+    num_particles = num_particles[order]
+
+    color_map = gridsquare_color_map(table.gridsquare_index)
+    gridsquare_colors = np.array([color_map[grid] for grid in table.gridsquare_index[known][order].tolist()]).reshape(-1, 3)
+
+    plt.figure(figsize=(12, 6))
+    plt.scatter(hours, num_particles, c=gridsquare_colors, s=8, edgecolor=None)
+    if len(num_particles) >= window:
+        rolling_mean = np.convolve(num_particles, np.ones(window) / window, mode="valid")
+        plt.plot(hours[window - 1:], rolling_mean, color="black", linewidth=1.5, label=f"Rolling Average ({window} Micrographs)")
         plt.legend(loc="upper left")
+    plt.xlabel("Hours Since First Micrograph")
+    plt.ylabel("Number of Particles in Micrograph")
+    plt.grid(alpha=0.25)
+    plt.savefig(f"{folder_name}/particles_vs_time.png")
+    plt.close()
 
-        plt.savefig(f"{folder_name}/particles_vs_transmission_gridsquares/particles_vs_transmission_sq{grid}.png")
-        plt.close()
+# Density image of micrographs per transmission bin and particle bin, drawn from precomputed histogram counts
+def plot_binned_density(ax, binned, density):
+    image = ax.imshow(
+        np.ma.masked_equal(density.T, 0), origin="lower", aspect="auto", cmap="viridis", interpolation="nearest",
+        extent=(binned.transmission_edges[0], binned.transmission_edges[-1], binned.particle_edges[0], binned.particle_edges[-1]),
+    )
+    plt.colorbar(image, ax=ax, label="Number of Micrographs")
+    ax.set_xlabel("Approximate Percent Transmission")
+    ax.set_ylabel("Number of Particles in Micrograph")
+
+# Density plot of Percent Transmission vs. Number of Particles for all micrographs
+def plot_particles_vs_transmission_density(table, stats, folder_name):
+    binned = stats["binned"]
+    plt.figure(figsize=(10, 6))
+    plot_binned_density(plt.gca(), binned, binned.density.sum(axis=0))
+    plt.savefig(f"{folder_name}/particles_vs_transmission_density.png")
+    plt.close()
+
+# Density plot of Percent Transmission vs. Number of Particles for a single grid square
+def plot_particles_vs_transmission_density_gridsquare(table, stats, folder_name, grid):
+    binned = stats["binned"]
+    plt.figure(figsize=(10, 6))
+    plot_binned_density(plt.gca(), binned, binned.density[grid - 1])
+    plt.title(f"Grid Square {grid}")
+    os.makedirs(f"{folder_name}/particles_vs_transmission_density_gridsquares", exist_ok=True)
+    plt.savefig(f"{folder_name}/particles_vs_transmission_density_gridsquares/particles_vs_transmission_density_sq{grid}.png")
+    plt.close()
+
+# Heatmap of average particles per micrograph for each transmission bin and applied defocus
+def plot_yield_vs_transmission_defocus(table, stats, folder_name):
+    binned = stats["binned"]
+    num_defocus = len(binned.defocus_keys)
+
+    plt.figure(figsize=(10, 6))
+    image = plt.imshow(
+        np.ma.masked_invalid(binned.yield_mean.T), origin="lower", aspect="auto", cmap="magma", interpolation="nearest",
+        extent=(binned.transmission_edges[0], binned.transmission_edges[-1], -0.5, max(num_defocus, 1) - 0.5),
+    )
+    plt.colorbar(image, label="Average Particles per Micrograph")
+    plt.yticks(np.arange(num_defocus), [f"{key:g}" for key in binned.defocus_keys.tolist()])
+    plt.xlabel("Approximate Percent Transmission")
+    plt.ylabel("Applied Defocus (µm)")
+    plt.savefig(f"{folder_name}/yield_vs_transmission_defocus.png")
+    plt.close()
+
+# Registry of independent plot jobs, each rendered from the micrograph table and the aggregated statistics
+# Plots in PER_GRIDSQUARE_PLOTS are split into one job per grid square
+PLOTS = {
+    "avg_particles": plot_avg_particles,
+    "percent_empty": plot_percent_empty,
+    "total_particles": plot_total_particles,
+    "distribution_particles_per_mic": plot_distribution_particles_per_mic,
+    "particles_per_mic": plot_particles_per_mic,
+    "particles_vs_defocus": plot_particles_vs_defocus,
+    "transmission_vs_gridsquare": plot_transmission_vs_gridsquare,
+    "particles_vs_transmission": plot_particles_vs_transmission,
+    "particles_vs_transmission_gridsquares": plot_particles_vs_transmission_gridsquare,
+    "particles_vs_time": plot_particles_vs_time,
+    "spatial_density_gridsquares": plot_spatial_density_gridsquare,
+    "particles_vs_transmission_density": plot_particles_vs_transmission_density,
+    "particles_vs_transmission_density_gridsquares": plot_particles_vs_transmission_density_gridsquare,
+    "yield_vs_transmission_defocus": plot_yield_vs_transmission_defocus,
+}
+PER_GRIDSQUARE_PLOTS = {"particles_vs_transmission_gridsquares", "spatial_density_gridsquares", "particles_vs_transmission_density_gridsquares"}
+
+# Shared inputs of the plot jobs, set once per worker process
+_plot_inputs = {}
+
+def _init_plot_worker(table, stats, folder_name):
+    install_fs_call_counter()
+    _plot_inputs.update(table=table, stats=stats, folder_name=folder_name)
+
+# Render one plot job, returning its wall time, filesystem calls and error message (None if it succeeded)
+# A failing plot is reported without stopping the other plot jobs
+def _run_plot_job(name, grid=None):
+    start_time = time.perf_counter()
+    start_fs_calls = fs_call_count()
+    args = (_plot_inputs["table"], _plot_inputs["stats"], _plot_inputs["folder_name"])
+    error = None
+    try:
+        if grid is None:
+            PLOTS[name](*args)
+        else:
+            PLOTS[name](*args, grid)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        plt.close("all")
+    return time.perf_counter() - start_time, fs_call_count() - start_fs_calls, error
+
+# Render the selected plots, on a pool of worker processes (Agg backend) when more than one worker is available
+# Per grid square plots can be limited to some grid square indices with grids
+# Given StageTimings, the time of each plot (summed over grid squares) is recorded as a plot:{name} stage
+def render_plots(table, stats, folder_name, plot_names, workers=1, grids=None, timings=None, job=None):
+    grids = np.unique(table.gridsquare_index).tolist() if grids is None else sorted(grids)
+    jobs = []
+    for name in plot_names:
+        if name in PER_GRIDSQUARE_PLOTS:
+            jobs.extend((name, grid) for grid in grids)
+        else:
+            jobs.append((name, None))
+
+    start_time = time.perf_counter()
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=_init_plot_worker, initargs=(table, stats, folder_name)) as executor:
+            results = list(executor.map(_run_plot_job, *zip(*jobs)))
+    else:
+        _init_plot_worker(table, stats, folder_name)
+        results = [_run_plot_job(name, grid) for name, grid in jobs]
+    print(f"Rendered {len(jobs)} plot jobs in {time.perf_counter() - start_time:.2f} s ({workers} workers)")
+    for (name, grid), (_, _, error) in zip(jobs, results):
+        if error is not None:
+            print(f"Error rendering plot {name}" + ("" if grid is None else f" for grid square {grid}") + f": {error}")
+
+    if timings is not None:
+        for name in plot_names:
+            plot_results = [result for (job_name, _), result in zip(jobs, results) if job_name == name]
+            seconds = sum(result[0] for result in plot_results)
+            fs_calls = sum(result[1] for result in plot_results)
+            timings.add(f"plot:{name}", seconds, len(plot_results), fs_calls, job)
+
+## Raw data path resolution
+
+JSON_READ_SIZE = 1 << 20
+RAWDATAPATH_MEMO_VERSION = 1
+MAX_LINEAGE_JOBS = 1000
+
+# Stream the items of a top-level JSON array one at a time, without loading the whole file
+# Files that do not hold an array are loaded whole and yielded as a single item
+def iter_json_array(json_path, read_size=JSON_READ_SIZE):
+    decoder = json.JSONDecoder()
+    with open(json_path, "r") as json_file:
+        buffer = json_file.read(read_size)
+        position = len(buffer) - len(buffer.lstrip())
+        if buffer[position:position + 1] != "[":
+            yield json.loads(buffer + json_file.read())
+            return
+        position += 1
+        end_of_file = False
+        while True:
+            # Skip whitespace and separators, reading more of the file as needed
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer) and not end_of_file:
+                buffer = json_file.read(read_size)
+                position = 0
+                end_of_file = not buffer
+                continue
+            if buffer[position:position + 1] in ("]", ""):
+                return
+            # An item that fails to decode or ends right at the end of the buffer (i.e. a number cut in two) may continue
+            # past the buffer, so it is decoded again with more of the file unless the file is exhausted
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                complete = end < len(buffer) or end_of_file
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+                complete = False
+            if not complete:
+                more = json_file.read(read_size)
+                end_of_file = not more
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            position = end
+            yield item
+
+# Read a job's job.json, None if it does not exist or cannot be read
+def read_job_json(job_dir):
+    try:
+        with open(os.path.join(job_dir, "job.json"), "r") as job_file:
+            return json.load(job_file)
+    except (OSError, ValueError):
+        return None
+
+# Walk a job and its inputs, breadth first, yielding (job uid, job.json contents) for every job in the lineage
+def iter_job_lineage(job):
+    project_dir = os.path.dirname(os.path.normpath(job))
+    queue = [os.path.basename(os.path.normpath(job))]
+    seen = set(queue)
+    while queue and len(seen) <= MAX_LINEAGE_JOBS:
+        job_uid = queue.pop(0)
+        job_data = read_job_json(os.path.join(project_dir, job_uid))
+        if job_data is None:
+            continue
+        yield job_uid, job_data
+        for input_group in job_data.get("input_slot_groups", []):
+            for connection in input_group.get("connections", []):
+                parent_uid = connection.get("job_uid")
+                if parent_uid and parent_uid not in seen:
+                    seen.add(parent_uid)
+                    queue.append(parent_uid)
+
+# Directory of the movies imported by an import job, i.e. /data/session/Images-Disc1 for .../Images-Disc1/GridSquare_*/Data/*.tiff
+def find_import_path(job_data):
+    blob_paths = job_data.get("params_spec", {}).get("blob_paths", {}).get("value")
+    if not isinstance(blob_paths, str) or not blob_paths:
+        return None
+    parts = blob_paths.split(os.sep)
+    for i, part in enumerate(parts):
+        if any(character in part for character in "*?["):
+            return os.sep.join(parts[:i]) or os.sep
+    return os.path.dirname(blob_paths)
+
+# Watch paths (file_engine_watch_path_abs) of the given workspaces / Live sessions, streaming workspaces.json
+# Also returns every watch path in the file, so a project with a single session can fall back to it
+def find_workspace_watch_paths(workspaces_json_path, workspace_uids):
+    watch_paths = {}
+    all_watch_paths = []
+    for workspace in iter_json_array(workspaces_json_path):
+        if not isinstance(workspace, dict):
+            continue
+        watch_path = workspace.get("file_engine_watch_path_abs")
+        if not watch_path:
+            continue
+        all_watch_paths.append(watch_path)
+        if workspace.get("uid") in workspace_uids:
+            watch_paths[workspace["uid"]] = watch_path
+    return watch_paths, all_watch_paths
+
+# Default location of the memoized raw data paths, next to the EPU metadata cache
+def default_rawdatapath_memo_path():
+    return os.path.join(os.path.dirname(default_metadata_cache_path()), "rawdatapaths.json")
+
+def load_rawdatapath_memo(memo_path):
+    try:
+        with open(memo_path, "r") as memo_file:
+            memo = json.load(memo_file)
+    except (OSError, ValueError):
+        return {}
+    return memo if memo.get("version") == RAWDATAPATH_MEMO_VERSION else {}
+
+def save_rawdatapath_memo(memo_path, memo):
+    os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+    temp_path = f"{memo_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as memo_file:
+        json.dump(dict(memo, version=RAWDATAPATH_MEMO_VERSION), memo_file, indent=1)
+    os.replace(temp_path, memo_path)
+
+# Find the raw data path of a job from the CryoSPARC project metadata, None if not found
+# Jobs are followed back through their inputs: the first with an import path (import jobs) or a workspace / Live session
+# watching a directory gives the raw data path. Results are memoized per project and job in memo_path, as long as
+# the job's job.json is unchanged and the path still exists
+def find_rawdatapath(job, memo_path=None):
+    project_dir = os.path.realpath(os.path.dirname(os.path.normpath(job)) or ".")
+    job_uid = os.path.basename(os.path.normpath(job))
+    memo_key = f"{project_dir}/{job_uid}"
+
+    try:
+        job_mtime = counted_stat(os.path.join(job, "job.json")).st_mtime
+        memo = load_rawdatapath_memo(memo_path) if memo_path else {}
+        memoized = memo.get("jobs", {}).get(memo_key)
+        if memoized and memoized["job_mtime"] == job_mtime and os.path.isdir(memoized["rawdatapath"]):
+            print(f"Automatically determined raw data path: {memoized['rawdatapath']} (memoized)")
+            return memoized["rawdatapath"]
+
+        # Candidates in lineage order, either an import path or a workspace whose watch path is looked up afterwards
+        candidates = []
+        for lineage_uid, job_data in iter_job_lineage(job):
+            import_path = find_import_path(job_data)
+            if import_path:
+                candidates.append((lineage_uid, "path", import_path))
+            candidates.extend((lineage_uid, "workspace", uid) for uid in job_data.get("workspace_uids", []) or [])
+        if not candidates:
+            raise ValueError(f"No job.json found for {job}")
+
+        workspace_uids = {value for _, kind, value in candidates if kind == "workspace"}
+        watch_paths, all_watch_paths = find_workspace_watch_paths(os.path.join(project_dir, "workspaces.json"), workspace_uids)
+
+        rawdatapath = None
+        for lineage_uid, kind, value in candidates:
+            rawdatapath = value if kind == "path" else watch_paths.get(value)
+            if rawdatapath:
+                print(f"Automatically determined raw data path: {rawdatapath} (from {lineage_uid})")
+                break
+        else:
+            if len(set(all_watch_paths)) == 1:
+                rawdatapath = all_watch_paths[0]
+                print(f"Automatically determined raw data path: {rawdatapath}")
+
+        if not rawdatapath:
+            raise ValueError("Raw data path not found in job.json or workspaces.json.")
+
+        if memo_path:
+            memo.setdefault("jobs", {})[memo_key] = {"rawdatapath": rawdatapath, "job_mtime": job_mtime}
+            save_rawdatapath_memo(memo_path, memo)
+        return rawdatapath
+
+    except Exception as e:
+        print(f"Error: {e}")
+        return None
+
+# Resolve the true raw data roots (i.e. .../Images-Disc1) from the raw data path, following every symlink in it
+# The raw data path may be a directory of grid square symlinks, an Images-Disc* directory, or an EPU session split
+# across several Images-Disc* directories
+def resolve_images_roots(rawdatapath):
+    images_roots = set()
+    with os.scandir(rawdatapath) as entries:
+        for entry in entries:
+            if entry.name.startswith("Images-Disc") and entry.is_dir():
+                count_fs_calls()
+                images_roots.add(os.path.realpath(entry.path))
+            elif entry.name.startswith("GridSquare") or entry.is_symlink():
+                count_fs_calls()
+                target = os.path.realpath(entry.path)
+                if "GridSquare" in target:
+                    images_roots.add(target.split("GridSquare")[0].rstrip(os.sep))
+    if not images_roots:
+        raise ValueError(f"No grid square directories found in {rawdatapath}")
+    return sorted(images_roots)
+
+## Stage timings
+
+# Python audit events counted as filesystem calls (os.walk and glob.glob are made of os.scandir calls and not counted again)
+# os.stat raises no audit event, so stats are counted explicitly with counted_stat
+FS_AUDIT_EVENTS = {
+    "open", "os.scandir", "os.listdir", "os.mkdir", "os.rename", "os.remove", "os.rmdir",
+    "os.symlink", "os.truncate", "os.chmod", "os.utime", "sqlite3.connect",
+}
+_fs_calls = {"count": 0, "installed": False}
+
+def _count_fs_call(event, args):
+    if event in FS_AUDIT_EVENTS:
+        _fs_calls["count"] += 1
+
+# Audit hooks cannot be removed, so the counter is installed at most once per process
+def install_fs_call_counter():
+    if not _fs_calls["installed"]:
+        sys.addaudithook(_count_fs_call)
+        _fs_calls["installed"] = True
+
+def fs_call_count():
+    return _fs_calls["count"]
+
+# Count filesystem calls that raise no audit event, i.e. os.stat and os.path.realpath, made where the pipeline calls them directly
+def count_fs_calls(calls=1):
+    _fs_calls["count"] += calls
+
+def counted_stat(path):
+    count_fs_calls()
+    return os.stat(path)
+
+# Wall time, item count, items/s and filesystem calls of every pipeline stage, saved as timings.json
+# Stages recorded without a job are shared by every job analyzed in the same run
+class StageTimings:
+    def __init__(self):
+        install_fs_call_counter()
+        self.start_time = time.perf_counter()
+        self.stages = []
+
+    def add(self, name, seconds, items=None, fs_calls=0, job=None):
+        self.stages.append({
+            "stage": name,
+            "job": job,
+            "seconds": seconds,
+            "items": items,
+            "items_per_second": items / seconds if items is not None and seconds > 0 else None,
+            "fs_calls": fs_calls,
+        })
+
+    # Time the body of a with block; the item count can be given up front or set on the yielded record
+    @contextmanager
+    def stage(self, name, items=None, job=None):
+        record = {"items": items}
+        start_time = time.perf_counter()
+        start_fs_calls = fs_call_count()
+        try:
+            yield record
+        finally:
+            self.add(name, time.perf_counter() - start_time, record["items"], fs_call_count() - start_fs_calls, job)
+
+    # Save the shared stages and those of one job
+    def save(self, json_path, job=None):
+        with open(json_path, "w") as f:
+            json.dump({
+                "job": job,
+                "total_seconds": time.perf_counter() - self.start_time,
+                "stages": [stage for stage in self.stages if stage["job"] in (None, job)],
+            }, f, indent=2)
+
+## Pipeline stages
+
+# Output folder for a job, i.e. particle_stats_J88 (the number after the last 'J' in the job input)
+def job_folder_name(job):
+    return f"particle_stats_J{job.split('J')[-1]}"
+
+# Create the particle_stats_JXX folder, with its inputs and output_CSVs subfolders, for every job
+def create_output_folders(jobs):
+    folder_names = [job_folder_name(job) for job in jobs]
+    for folder_name in folder_names:
+        os.makedirs(f"{folder_name}/inputs", exist_ok=True)
+        os.makedirs(f"{folder_name}/output_CSVs", exist_ok=True)
+    return folder_names
+
+# Build the micrograph table from the EPU index, in acquisition order with grid squares numbered in order of first visit
+def build_micrograph_table(epu_index):
+    # Sort micrograph paths by timestamp
+    micrograph_paths = sorted(
+        epu_index["fractions"].values(),
+        key=lambda path: extract_timestamp(path)  # Sort by extracted timestamp
+    )
+
+    # Extract micrograph names and grid squares (GridSquare_*)
+    micrographs = [os.path.splitext(os.path.basename(path))[0] for path in micrograph_paths]
+    gridsquares = [epu_index["gridsquares"][foilhole_stem(micrograph)] for micrograph in micrographs]
+
+    # Assign grid square indices based on the sorted order of timestamps
+    grid_square_map = {}
+    for gridsquare in gridsquares:
+        grid_square_map.setdefault(gridsquare, len(grid_square_map) + 1)
+
+    # Initialize the micrograph table with zero particles and no metadata
+    return new_micrograph_table(micrographs, list(grid_square_map), [grid_square_map[gridsquare] for gridsquare in gridsquares])
+
+# Matching XML file for each micrograph in the index, None if there is none (yet)
+def find_xml_paths(epu_index, micrograph_names):
+    return [epu_index["xml"].get(foilhole_stem(micrograph_name)) for micrograph_name in micrograph_names]
+
+# Count particles per micrograph for one job, from its .cs files or else with cs2star and particles.star
+def count_job_particles(job, folder_name, micrograph_names):
+    particle_counts = count_particles_from_cs(job, micrograph_names)
+    if particle_counts is None:
+        print(f"No readable particle .cs file found for {job}, falling back to cs2star")
+        particle_counts = count_particles_per_micrograph(iter_particle_micrographs_star(job, folder_name), micrograph_names)
+    return particle_counts
+
+# count_job_particles in a worker process, also returning the filesystem calls it made
+def _count_job_particles_in_worker(job, folder_name, micrograph_names):
+    start_fs_calls = fs_call_count()
+    return count_job_particles(job, folder_name, micrograph_names), fs_call_count() - start_fs_calls
+
+# Count particles per micrograph for several jobs against the same micrographs, one job per worker process
+def count_particles_for_jobs(jobs, folder_names, micrograph_names, workers=1):
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=install_fs_call_counter) as executor:
+            counts_per_job, fs_calls = zip(*executor.map(_count_job_particles_in_worker, jobs, folder_names, [micrograph_names] * len(jobs)))
+        count_fs_calls(sum(fs_calls))
+        return list(counts_per_job)
+    return [count_job_particles(job, folder_name, micrograph_names) for job, folder_name in zip(jobs, folder_names)]
+
+# Change over to approximate percent transmission from dose, relative to the highest dose in the session
+def dose_to_transmission(raw_dose_on_camera):
+    if np.all(np.isnan(raw_dose_on_camera)):
+        return raw_dose_on_camera.copy()
+    return (raw_dose_on_camera / np.nanmax(raw_dose_on_camera)) * 100
+
+# Write the output tables, with the statistics computed by aggregate_stats
+def save_outputs(table, stats, folder_name):
+    # Save the main table as a .csv file
+    csv_file_path = f"{folder_name}/output_CSVs/allmicstats.csv"
+    save_micrograph_table_csv(table, csv_file_path)
+    print(f"Saved main array to {csv_file_path}")
+
+    # Save the same table as typed columns for fast reloading with load_results
+    npz_file_path = f"{folder_name}/output_CSVs/allmicstats.npz"
+    save_micrograph_table_npz(table, npz_file_path)
+    print(f"Saved typed micrograph table to {npz_file_path}")
+
+    # Use the grid square names to create the grid square indices table
+    txt_file_path = f"{folder_name}/output_CSVs/gridsquareindices.txt"
+    with open(txt_file_path, "w") as f:
+        f.write("Grid Square Index\tGrid Square Name\n")
+        for grid_square_index, grid_square_name in enumerate(table.gridsquare_names, start=1):
+            f.write(f"{grid_square_index}\t{grid_square_name}\n")
+    print(f"Saved grid square indices to {txt_file_path}")
+
+    # Save the grid square table
+    gridsquare_csv_path = f"{folder_name}/output_CSVs/gridsquare_stats.csv"
+    save_gridsquare_stats_csv(table, stats, gridsquare_csv_path)
+    print(f"Saved grid square statistics to {gridsquare_csv_path}")
+
+    binned_yield_csv_path = f"{folder_name}/output_CSVs/binned_transmission_defocus.csv"
+    save_binned_yield_csv(stats, binned_yield_csv_path)
+    binned_density_csv_path = f"{folder_name}/output_CSVs/binned_particles_vs_transmission.csv"
+    save_binned_density_csv(stats, binned_density_csv_path)
+    print(f"Saved binned statistics to {binned_yield_csv_path} and {binned_density_csv_path}")
+
+    spatial_csv_path = f"{folder_name}/output_CSVs/spatial_stats.csv"
+    save_spatial_stats_csv(table, stats, spatial_csv_path)
+    print(f"Saved spatial statistics to {spatial_csv_path}")
+
+## Live mode
+
+# Follows an ongoing EPU session and CryoSPARC job, keeping the EPU index, micrograph table, metadata and particle counts between polls
+# Each poll only rescans changed Data directories, parses new XML files and counts particles added since the last poll
+class LiveSession:
+    def __init__(self, job, folder_name, images_roots, workers=1, cache_path=None, plot_names=None):
+        self.job = job
+        self.folder_name = folder_name
+        self.images_roots = images_roots
+        self.workers = workers
+        self.cache_path = cache_path
+        self.plot_names = plot_names
+        self.epu_index = None
+        self.table = None
+        self.raw_dose_on_camera = np.array([])
+        self.row_of_stem = {}
+        self.particle_counts = {}  # FoilHole stem -> particles
+        self.particle_source = (None, 0, None)  # (.cs file, rows already counted, uid of the last row counted)
+        self.failed_xml = {}  # XML path -> mtime, for files that gave no DoseOnCamera and are only parsed again once changed
+
+    # Fill table rows from the particle counts, returning the grid squares of rows whose count changed
+    def _apply_particle_counts(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        counts = np.array([self.particle_counts.get(foilhole_stem(name), 0) for name in self.table.micrograph_names[rows].tolist()], dtype=np.uint32)
+        changed = rows[self.table.num_particles[rows] != counts]
+        self.table.num_particles[rows] = counts
+        return set(self.table.gridsquare_index[changed].tolist())
+
+    # Add micrographs found since the last poll, returning the grid squares they belong to
+    def _update_micrographs(self):
+        self.epu_index = index_epu_directory(self.images_roots, self.epu_index)
+        new_stems = sorted(self.epu_index["new_fractions"], key=lambda stem: extract_timestamp(stem + "_Fractions"))
+        if not new_stems:
+            return set()
+
+        # Micrographs are normally acquired after every row already in the table, otherwise the table is rebuilt in order
+        last_timestamp = extract_timestamp(self.table.micrograph_names[-1]) if self.table is not None and len(self.table) else None
+        if last_timestamp is None or extract_timestamp(new_stems[0] + "_Fractions") < last_timestamp:
+            self.table = build_micrograph_table(self.epu_index)
+            self.raw_dose_on_camera = np.full(len(self.table), np.nan)
+            new_rows = np.arange(len(self.table))
+        else:
+            micrographs = [os.path.splitext(os.path.basename(self.epu_index["fractions"][stem]))[0] for stem in new_stems]
+            self.table = append_micrograph_rows(self.table, micrographs, [self.epu_index["gridsquares"][stem] for stem in new_stems])
+            self.raw_dose_on_camera = np.concatenate([self.raw_dose_on_camera, np.full(len(new_stems), np.nan)])
+            new_rows = np.arange(len(self.table) - len(new_stems), len(self.table))
+
+        self.row_of_stem = {foilhole_stem(name): i for i, name in enumerate(self.table.micrograph_names.tolist())}
+        self._apply_particle_counts(new_rows)
+        print(f"Found {len(new_stems)} new micrographs ({len(self.table)} total)")
+        return set(self.table.gridsquare_index[new_rows].tolist())
+
+    # Parse the XML files of micrographs that do not have metadata yet, returning their grid squares
+    def _update_metadata(self):
+        pending = np.flatnonzero(np.isnan(self.raw_dose_on_camera))
+        micrographs = self.table.micrograph_names[pending].tolist()
+        rows = []
+        xml_paths = []
+        xml_mtimes = []
+        for row, xml_path in zip(pending.tolist(), find_xml_paths(self.epu_index, micrographs)):
+            if xml_path is None:
+                continue
+            try:
+                xml_mtime = counted_stat(xml_path).st_mtime
+            except OSError:
+                continue
+            # Files that could not be read are skipped until they change, i.e. once EPU has finished writing them
+            if self.failed_xml.get(xml_path) != xml_mtime:
+                rows.append(row)
+                xml_paths.append(xml_path)
+                xml_mtimes.append(xml_mtime)
+        if not rows:
+            return set()
+
+        raw_dose_on_camera, applied_defocus, stage_x, stage_y = load_xml_metadata(
+            xml_paths,
+            self.table.micrograph_names[rows].tolist(),
+            self.table.gridsquare_names[self.table.gridsquare_index[rows] - 1].tolist(),
+            self.workers,
+            cache_path=self.cache_path,
+        )
+        self.raw_dose_on_camera[rows] = raw_dose_on_camera
+        self.table.applied_defocus[rows] = applied_defocus
+        self.table.stage_x[rows] = stage_x
+        self.table.stage_y[rows] = stage_y
+        for xml_path, xml_mtime, dose in zip(xml_paths, xml_mtimes, raw_dose_on_camera.tolist()):
+            if np.isnan(dose):
+                self.failed_xml[xml_path] = xml_mtime
+            else:
+                self.failed_xml.pop(xml_path, None)
+
+        # Transmission is relative to the highest dose, so a new maximum changes every row
+        previous_transmission = self.table.transmission.copy()
+        self.table.transmission[:] = dose_to_transmission(self.raw_dose_on_camera)
+        changed = ~np.isclose(previous_transmission, self.table.transmission, equal_nan=True)
+        changed[rows] = True
+        return set(self.table.gridsquare_index[changed].tolist())
+
+    # uid of a .cs row, None for files without uids (which are then always counted from the start)
+    @staticmethod
+    def _row_uid(particles, row):
+        if "uid" not in (particles.dtype.names or ()):
+            return None
+        return int(particles["uid"][row])
+
+    # Count particles added to the job since the last poll, returning the grid squares whose counts changed
+    def _update_particles(self):
+        cs_path = find_readable_particle_cs_file(self.job)
+        if cs_path is not None:
+            # Particle files are normally only appended to, so only the rows after the ones already counted are read
+            # A file rewritten in place no longer has the same uid in the last row counted, and is counted again from the start
+            particles = np.load(cs_path, mmap_mode="r")
+            num_rows = len(particles)
+            last_cs_path, start_row, last_uid = self.particle_source
+            if cs_path != last_cs_path or num_rows < start_row:
+                start_row = 0
+            elif start_row and (last_uid is None or self._row_uid(particles, start_row - 1) != last_uid):
+                start_row = 0
+            if num_rows == start_row:
+                return set()
+            new_counts = count_particles_per_stem(iter_cs_field(cs_path, CS_MICROGRAPH_FIELD, start_row=start_row))
+            self.particle_source = (cs_path, num_rows, self._row_uid(particles, num_rows - 1))
+            del particles
+            print(f"Counted {num_rows - start_row} new particles from {cs_path}")
+        else:
+            # particles.star is rewritten by cs2star every time, so every particle is counted again
+            new_counts = count_particles_per_stem(iter_particle_micrographs_star(self.job, self.folder_name))
+            start_row = 0
+
+        # After counting from the start, every row is refreshed so particles that disappeared are dropped too
+        if start_row == 0:
+            self.particle_counts = new_counts
+            return self._apply_particle_counts(np.arange(len(self.table)))
+        for stem, count in new_counts.items():
+            self.particle_counts[stem] = self.particle_counts.get(stem, 0) + count
+        return self._apply_particle_counts([self.row_of_stem[stem] for stem in new_counts if stem in self.row_of_stem])
+
+    # Update the table with new data, then rewrite the tables and re-render the plots whose inputs changed
+    # Returns the set of grid square indices that changed, the stage timings of the poll are saved to timings.json
+    def poll(self):
+        timings = StageTimings()
+        with timings.stage("discover_micrographs") as stage:
+            changed_grids = self._update_micrographs()
+            stage["items"] = len(self.epu_index["new_fractions"])
+        if self.table is None or not len(self.table):
+            print("No micrographs found yet")
+            return set()
+        with timings.stage("parse_xml"):
+            changed_grids |= self._update_metadata()
+        with timings.stage("count_particles"):
+            changed_grids |= self._update_particles()
+        if changed_grids:
+            with timings.stage("aggregate", items=len(self.table)):
+                stats = aggregate_stats(self.table)
+            with timings.stage("write_csv", items=len(self.table)):
+                save_outputs(self.table, stats, self.folder_name)
+            if self.plot_names:
+                with timings.stage("plots", items=len(self.plot_names)):
+                    render_plots(self.table, stats, self.folder_name, self.plot_names, self.workers, grids=changed_grids, timings=timings)
+        else:
+            print("No new data")
+        timings.save(f"{self.folder_name}/timings.json", self.job)
+        return changed_grids
+
+# Poll a live session every interval seconds until interrupted
+def watch_session(session, interval):
+    print(f"Watching {', '.join(session.images_roots)} every {interval} s (Ctrl+C to stop)")
+    try:
+        while True:
+            start_time = time.perf_counter()
+            changed_grids = session.poll()
+            elapsed = time.perf_counter() - start_time
+            print(f"Poll finished in {elapsed:.2f} s, {len(changed_grids)} grid squares updated")
+            time.sleep(max(0, interval - elapsed))
+    except KeyboardInterrupt:
+        print("Stopped watching")
+
+def main():
+
+    ## Check inputs and generate required folders / paths
+
+    parser = argparse.ArgumentParser(usage="python particle_distribution.py {job} {rawdatapath (optional)} [options]")
+    parser.add_argument("job", help="CryoSPARC job directory, i.e. J88")
+    parser.add_argument("rawdatapath", nargs="?", default=None, help="Path to the raw data (symlinks), found automatically if not given")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the persistent EPU metadata cache and memoized raw data paths")
+    parser.add_argument("--rebuild-cache", action="store_true", help="Parse every XML file again and replace its metadata cache entry")
+    parser.add_argument("--plots", nargs="+", choices=list(PLOTS), metavar="PLOT", help=f"Only render these plots ({', '.join(PLOTS)})")
+    parser.add_argument("--no-plots", action="store_true", help="Only write the output tables, without rendering any plots")
+    parser.add_argument("--workers", type=int, default=min(32, os.cpu_count() or 1), help="Number of worker processes for XML parsing and plotting")
+    parser.add_argument("--jobs", nargs="+", default=[], metavar="JOB", help="More CryoSPARC jobs to analyze against the same raw data, which is only scanned once")
+    parser.add_argument("--watch", action="store_true", help="Keep following an ongoing session, updating the outputs with new micrographs and particles")
+    parser.add_argument("--interval", type=float, default=180, help="Seconds between updates in --watch mode")
+    parser.add_argument("--profile", action="store_true", help="Profile the run with cProfile and save the stats to particle_stats_JXX/profile.pstats")
+    args = parser.parse_args()
+
+    job = args.job
+    workers = max(1, args.workers)
+    jobs = [job] + [extra_job for extra_job in args.jobs if extra_job != job]
+    if args.watch and len(jobs) > 1:
+        parser.error("--watch follows a single job, it cannot be combined with --jobs")
+
+    # Create the main folder and the inputs subfolder for every job
+    folder_names = create_output_folders(jobs)
+    folder_name = folder_names[0]
+
+    if args.profile:
+        # Only the main process is profiled, worker processes are timed in timings.json
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run_analysis, args, jobs, folder_names, workers)
+        finally:
+            profile_path = f"{folder_name}/profile.pstats"
+            profiler.dump_stats(profile_path)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+            print(f"Saved profile to {profile_path} (view with python -m pstats {profile_path})")
+    else:
+        run_analysis(args, jobs, folder_names, workers)
+
+# Find the raw data, build the micrograph table and save the tables and plots of every job
+# Stage timings are recorded in timings (a new StageTimings if not given), which is returned
+def run_analysis(args, jobs, folder_names, workers, timings=None):
+    job = jobs[0]
+    folder_name = folder_names[0]
+    cache_path = None if args.no_cache else default_metadata_cache_path()
+    plot_names = [] if args.no_plots else args.plots or list(PLOTS)
+    timings = StageTimings() if timings is None else timings
+
+    # Determine rawdatapath
+    with timings.stage("resolve_rawdatapath"):
+        rawdatapath = args.rawdatapath or find_rawdatapath(job, None if args.no_cache else default_rawdatapath_memo_path())
+    if not rawdatapath:
+        print("Raw data path not found automatically. Please supply path to raw data in the command (i.e. python particle_distribution.py {job} {rawdatapath})")
+        return timings
+
+    ## Follow a live session
+
+    if args.watch:
+        session = LiveSession(job, folder_name, resolve_images_roots(rawdatapath), workers, cache_path, plot_names)
+        watch_session(session, args.interval)
+        return timings
+
+    ## Create micrograph table
+
+    print(f"Generating micrograph table... (this step will take a few minutes)")
+    
+    try:        
+        # Index all micrograph movies and XML files in a single pass over the EPU directories
+        with timings.stage("resolve_images_roots") as stage:
+            images_roots = resolve_images_roots(rawdatapath)
+            stage["items"] = len(images_roots)
+        with timings.stage("discover_micrographs") as stage:
+            epu_index = index_epu_directory(images_roots)
+            print(f"Indexed {len(epu_index['fractions'])} micrographs and {len(epu_index['xml'])} XML files from {epu_index['entries']} directory entries in {epu_index['seconds']:.2f} s")
+            table = build_micrograph_table(epu_index)
+            stage["items"] = len(table)
+
+        # Count particles from each job's .cs files, or fall back to cs2star and particles.star
+        with timings.stage("count_particles") as stage:
+            counts_per_job = count_particles_for_jobs(jobs, folder_names, table.micrograph_names, workers)
+            stage["items"] = int(sum(np.sum(particle_counts) for particle_counts in counts_per_job))
+
+        # Find the matching XML file for each micrograph in the index
+        micrographs = table.micrograph_names.tolist()
+        xml_paths = find_xml_paths(epu_index, micrographs)
+        for micrograph_name, xml_path in zip(micrographs, xml_paths):
+            if xml_path is None:
+                print(f"No matching XML file found for micrograph {micrograph_name}")
+
+        # Populate DoseOnCamera, AppliedDefocus and the stage position
+        gridsquares = table.gridsquare_names[table.gridsquare_index - 1].tolist()
+        with timings.stage("parse_xml", items=sum(xml_path is not None for xml_path in xml_paths)):
+            raw_dose_on_camera, applied_defocus, stage_x, stage_y = load_xml_metadata(
+                xml_paths, micrographs, gridsquares, workers, cache_path=cache_path, rebuild_cache=args.rebuild_cache
+            )
+        with timings.stage("normalize", items=len(table)):
+            table.transmission[:] = dose_to_transmission(raw_dose_on_camera)
+            table.applied_defocus[:] = applied_defocus
+            table.stage_x[:] = stage_x
+            table.stage_y[:] = stage_y
+
+    except Exception as e:
+        print(f"Error creating micrograph table: {e}")
+
+    ## Save arrays and make graphs for every job
+
+    for each_job, each_folder_name, particle_counts in zip(jobs, folder_names, counts_per_job):
+        job_table = replace(table, num_particles=np.asarray(particle_counts, dtype=np.uint32))
+        # Compute all per grid square, per defocus, binned and spatial statistics once, for the tables and the plots
+        with timings.stage("aggregate", items=len(job_table), job=each_job):
+            stats = aggregate_stats(job_table)
+        with timings.stage("write_csv", items=len(job_table), job=each_job):
+            save_outputs(job_table, stats, each_folder_name)
+
+        if not plot_names:
+            print(f"Skipping plots")
+        else:
+            print(f"Generating plots for {each_job}...")
+            with timings.stage("plots", items=len(plot_names), job=each_job):
+                render_plots(job_table, stats, each_folder_name, plot_names, workers, timings=timings, job=each_job)
+
+    # Combined table with one particle count column per job
+    if len(jobs) > 1:
+        jobs_csv_path = f"{folder_name}/output_CSVs/allmicstats_jobs.csv"
+        with timings.stage("write_jobs_csv", items=len(table)):
+            save_jobs_csv(table, jobs, counts_per_job, jobs_csv_path)
+        print(f"Saved particle counts for {len(jobs)} jobs to {jobs_csv_path}")
+
+    # Save the stage timings of every job
+    for each_job, each_folder_name in zip(jobs, folder_names):
+        timings.save(f"{each_folder_name}/timings.json", each_job)
+    print(f"Saved stage timings to {folder_name}/timings.json")
 
     current_directory = os.getcwd()
-    print(f"Done! All outputs saved in {current_directory}/{folder_name}")
+    print(f"Done! All outputs saved in {', '.join(f'{current_directory}/{each_folder_name}' for each_folder_name in folder_names)}")
+    return timings
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,162 @@
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import particle_distribution
+
+XML_TEMPLATE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    '<MicroscopeImage xmlns="http://schemas.datacontract.org/2004/07/Fei.SharedObjects" '
+    'xmlns:a="http://schemas.microsoft.com/2003/10/Serialization/Arrays">'
+    "<CustomData>{custom_data}</CustomData>"
+    "<microscopeData><stage><Position><X>{x}</X><Y>{y}</Y></Position></stage></microscopeData>"
+    "</MicroscopeImage>"
+)
+
+## Fake EPU session and CryoSPARC job
+
+def micrograph_stem(hole, second):
+    return f"FoilHole_{hole}_Data_1_2_20240101_1000{second:02d}"
+
+# Write a movie and its XML file, without DoseOnCamera when dose is None
+def add_micrograph(images_root, gridsquare, hole, second, dose=30.0, defocus=-1.2e-6):
+    data_dir = os.path.join(images_root, gridsquare, "Data")
+    os.makedirs(data_dir, exist_ok=True)
+    stem = micrograph_stem(hole, second)
+    open(os.path.join(data_dir, f"{stem}_Fractions.tiff"), "w").close()
+    values = {"AppliedDefocus": defocus} if dose is None else {"DoseOnCamera": dose, "AppliedDefocus": defocus}
+    custom_data = "".join(
+        f"<a:KeyValueOfstringanyType><a:Key>{key}</a:Key><a:Value>{value}</a:Value></a:KeyValueOfstringanyType>"
+        for key, value in values.items()
+    )
+    with open(os.path.join(data_dir, f"{stem}.xml"), "w") as f:
+        f.write(XML_TEMPLATE.format(custom_data=custom_data, x=hole * 1e-6, y=-hole * 1e-6))
+    return stem
+
+# Write the job's particle .cs file, one row per (uid, micrograph stem)
+def write_particles(job_dir, particles):
+    rows = np.zeros(len(particles), dtype=[("uid", "<u8"), ("location/micrograph_path", "S120")])
+    for row, (uid, stem) in enumerate(particles):
+        rows[row] = (uid, f"J2/motioncorrected/{uid}_{stem}_Fractions_patch_aligned_doseweighted.mrc")
+    with open(os.path.join(job_dir, "J1_passthrough_particles.cs"), "wb") as f:
+        np.save(f, rows)
+
+# Move every Data directory's mtime into the past, so polls skip the directories that do not change afterwards
+def age_data_dirs(images_root):
+    past = time.time() - 100
+    for gridsquare in os.listdir(images_root):
+        os.utime(os.path.join(images_root, gridsquare, "Data"), (past, past))
+
+def make_session(tmp_path):
+    images_root = str(tmp_path / "Images-Disc1")
+    job_dir = str(tmp_path / "J1")
+    folder_name = str(tmp_path / "particle_stats_J1")
+    os.makedirs(images_root)
+    os.makedirs(job_dir)
+    os.makedirs(os.path.join(folder_name, "output_CSVs"))
+    session = particle_distribution.LiveSession(job_dir, folder_name, [images_root], workers=1, cache_path=None, plot_names=[])
+    return session, images_root, job_dir
+
+# Micrograph table built in one go from the current files, as without --watch
+def one_shot_table(images_root, job_dir):
+    epu_index = particle_distribution.index_epu_directory([images_root])
+    table = particle_distribution.build_micrograph_table(epu_index)
+    table.num_particles[:] = particle_distribution.count_particles_from_cs(job_dir, table.micrograph_names)
+    micrographs = table.micrograph_names.tolist()
+    raw_dose_on_camera, applied_defocus, stage_x, stage_y = particle_distribution.load_xml_metadata(
+        particle_distribution.find_xml_paths(epu_index, micrographs), micrographs,
+        table.gridsquare_names[table.gridsquare_index - 1].tolist(),
+    )
+    table.transmission[:] = particle_distribution.dose_to_transmission(raw_dose_on_camera)
+    table.applied_defocus[:] = applied_defocus
+    table.stage_x[:] = stage_x
+    table.stage_y[:] = stage_y
+    return table
+
+def assert_same_table(table, expected):
+    assert table.micrograph_names.tolist() == expected.micrograph_names.tolist()
+    assert table.gridsquare_names.tolist() == expected.gridsquare_names.tolist()
+    np.testing.assert_array_equal(table.micrograph_index, expected.micrograph_index)
+    np.testing.assert_array_equal(table.gridsquare_index, expected.gridsquare_index)
+    np.testing.assert_array_equal(table.num_particles, expected.num_particles)
+    for column in ["transmission", "applied_defocus", "stage_x", "stage_y"]:
+        np.testing.assert_allclose(getattr(table, column), getattr(expected, column), equal_nan=True)
+
+## Tests
+
+def test_polls_match_one_shot_table(tmp_path):
+    session, images_root, job_dir = make_session(tmp_path)
+    a1 = add_micrograph(images_root, "GridSquare_1", 11, 1, dose=40.0)
+    a2 = add_micrograph(images_root, "GridSquare_1", 12, 2, dose=20.0)
+    b1 = add_micrograph(images_root, "GridSquare_2", 21, 3, dose=10.0)
+    age_data_dirs(images_root)
+    particles = [(1, a1), (2, a1), (3, b1)]
+    write_particles(job_dir, particles)
+
+    assert session.poll() == {1, 2}
+    assert_same_table(session.table, one_shot_table(images_root, job_dir))
+
+    # Appended: later micrographs in an existing and a new grid square, with a new maximum dose, and more particles
+    b2 = add_micrograph(images_root, "GridSquare_2", 22, 4, dose=80.0)
+    c1 = add_micrograph(images_root, "GridSquare_3", 31, 5, dose=50.0)
+    age_data_dirs(images_root)
+    particles += [(4, b2), (5, c1), (6, a2)]
+    write_particles(job_dir, particles)
+
+    session.poll()
+    assert session.particle_source[1] == len(particles)
+    assert_same_table(session.table, one_shot_table(images_root, job_dir))
+
+    # Nothing changed, so no Data directory is read again
+    assert session.poll() == set()
+    assert session.epu_index["entries"] == 3
+
+    # A micrograph acquired before the last one makes the table be rebuilt in order
+    add_micrograph(images_root, "GridSquare_1", 13, 0, dose=60.0)
+    session.poll()
+    assert_same_table(session.table, one_shot_table(images_root, job_dir))
+
+def test_rewritten_particle_file_is_counted_again(tmp_path):
+    session, images_root, job_dir = make_session(tmp_path)
+    a1 = add_micrograph(images_root, "GridSquare_1", 11, 1)
+    a2 = add_micrograph(images_root, "GridSquare_1", 12, 2)
+    write_particles(job_dir, [(1, a1), (2, a1)])
+    session.poll()
+
+    # Same path and as many rows, but different particles (i.e. the job was cleared and rerun)
+    write_particles(job_dir, [(7, a2), (8, a2), (9, a1)])
+    session.poll()
+    assert_same_table(session.table, one_shot_table(images_root, job_dir))
+    assert session.table.num_particles.tolist() == [1, 2]
+
+def test_unreadable_xml_is_only_parsed_again_once_changed(tmp_path, monkeypatch):
+    session, images_root, job_dir = make_session(tmp_path)
+    add_micrograph(images_root, "GridSquare_1", 11, 1)
+    stem = add_micrograph(images_root, "GridSquare_1", 12, 2, dose=None)
+    write_particles(job_dir, [])
+
+    parsed = []
+    load_xml_metadata = particle_distribution.load_xml_metadata
+    def counting_load_xml_metadata(xml_paths, *args, **kwargs):
+        parsed.extend(xml_paths)
+        return load_xml_metadata(xml_paths, *args, **kwargs)
+    monkeypatch.setattr(particle_distribution, "load_xml_metadata", counting_load_xml_metadata)
+
+    session.poll()
+    assert len(parsed) == 2
+    assert np.isnan(session.table.transmission[1])
+
+    session.poll()
+    assert len(parsed) == 2
+
+    # EPU finished writing the file
+    add_micrograph(images_root, "GridSquare_1", 12, 2, dose=15.0)
+    xml_path = os.path.join(images_root, "GridSquare_1", "Data", f"{stem}.xml")
+    os.utime(xml_path, (time.time() + 10, time.time() + 10))
+    session.poll()
+    assert parsed[2:] == [xml_path]
+    assert_same_table(session.table, one_shot_table(images_root, job_dir))